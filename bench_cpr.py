@@ -0,0 +1,374 @@
+#! /usr/bin/python
+# -*- coding: UTF-8
+
+###############################################################################
+# CannedPostResponder
+# by Charlie Pashayan                                                          
+# 2012                                                                         
+# bench_cpr.py: Replays recorded or made up submissions through
+# CannedPostResponder, without going near Reddit, and reports how fast it goes
+#                                                                              
+# Copyright (c) 2012 Charlie Pashayan                                          
+#                                                                              
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to     
+# deal in the Software without restriction, including without limitation the   
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or  
+# sell copies of the Software, and to permit persons to whom the Software is   
+# furnished to do so, subject to the following conditions:                     
+#                                                                              
+# The above copyright notice and this permission notice shall be included in   
+# all copies or substantial portions of the Software.                         
+#                                                                             
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+###############################################################################
+
+import cannedpostresponder
+import io_cpr
+import argparse
+import json
+import marshal
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+program_description = ("Feed recorded or made up submissions through "
+                       "CannedPostResponder, with a stand-in for Reddit, and "
+                       "report posts per second, what each instruction costs "
+                       "and how much memory is used.")
+
+syllables = ("ka lo mi ne su ta ri po ve da zu he fo gi ba ro".split())
+
+class StubSubmission:
+    """Just enough of a praw Submission for CannedPostResponder."""
+    def __init__(self, subreddit, id, created_utc, title, selftext):
+        self.id = id
+        self.created_utc = created_utc
+        self.title = title
+        self.selftext = selftext
+        self.permalink = ("http://www.reddit.com/r/%s/comments/%s/_/" % 
+                          (subreddit, id))
+        self.reply = None
+
+    def add_comment(self, text):
+        self.reply = text
+
+class StubSubreddit:
+    def __init__(self, posts):
+        self.posts = posts
+
+    def get_new(self, place_holder = None, limit = None):
+        """Newest first, stopping at place_holder, as praw does."""
+        for number, submission in enumerate(reversed(self.posts)):
+            if limit and number >= limit:
+                return
+            yield submission
+            if submission.id == place_holder:
+                return
+
+class StubReddit:
+    """Stands in for praw.Reddit, serving submissions from a corpus, which
+    is a dictionary of subreddit names to lists of submissions, oldest 
+    first."""
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def get_subreddit(self, name):
+        return StubSubreddit(self.corpus.get(name, []))
+
+    def get_unread(self, limit = None):
+        return []
+
+class BenchResponder(cannedpostresponder.CannedPostResponder):
+    """A CannedPostResponder that never sends email."""
+    def open_smtp(self):
+        self.smtp = None
+        self.email_on = False
+
+def relocate(directory):
+    """Points all of CannedPostResponder's files into directory, so a 
+    benchmark never touches the real ones."""
+    old = cannedpostresponder.path
+    for name in dir(cannedpostresponder):
+        value = getattr(cannedpostresponder, name)
+        if name.endswith("_file") and isinstance(value, str) and \
+                value.startswith(old):
+            setattr(cannedpostresponder, name, 
+                    os.path.join(directory, value[len(old):]))
+    cannedpostresponder.path = directory + os.sep
+
+def make_words(count, rand):
+    """Made up words, so instructions don't share keywords more often than
+    real ones would."""
+    words = set()
+    while len(words) < count:
+        words.add("".join(rand.choice(syllables) 
+                          for i in range(rand.randint(2, 4))))
+    return sorted(words)
+
+def make_instructions(count, words, rand):
+    """Makes up count instructions, mostly short phrases with an 
+    alternation in them, like most real instructions, plus the odd one 
+    with no literal text at all for the keyword index to go on.  Returns
+    the lines of the instructions file and, for each instruction, a phrase
+    it matches."""
+    lines = []
+    samples = []
+    for number in range(count):
+        if number % 25 == 24:
+            length = 6 + number % 5
+            lines.append('r"(\\w)\\1{%d}", "response.txt"' % length)
+            samples.append("z" * (length + 1))
+            continue
+        first, second, third, last = rand.sample(words, 4)
+        lines.append('r"\\b%s\\s+(%s|%s)\\s+%s\\b", re.I, "response.txt"' %
+                     (first, second, third, last))
+        samples.append(" ".join([first, rand.choice([second, third]), last]))
+    return lines, samples
+
+def make_corpus(count, subreddits, words, samples, match_rate, rand):
+    """Makes up count submissions, spread over the subreddits, a 
+    match_rate fraction of which contain a phrase some instruction 
+    matches."""
+    corpus = dict(("bench%d" % number, []) for number in range(subreddits))
+    names = sorted(corpus)
+    for number in range(count):
+        title = " ".join(rand.choice(words) for i in range(rand.randint(4, 12)))
+        body = [rand.choice(words) for i in range(rand.randint(0, 80))]
+        if rand.random() < match_rate:
+            body.insert(rand.randint(0, len(body)), rand.choice(samples))
+        subreddit = names[number % subreddits]
+        corpus[subreddit].append(StubSubmission(subreddit, "%x" % number, 
+                                                1.0e9 + number, title, 
+                                                " ".join(body)))
+    return corpus
+
+def load_corpus(filename):
+    """Reads a recorded corpus: one JSON object per line, with subreddit,
+    id, created_utc, title and selftext, oldest first."""
+    corpus = {}
+    for line in open(filename, "r"):
+        if not line.strip():
+            continue
+        post = json.loads(line)
+        corpus.setdefault(post["subreddit"], []).append(
+            StubSubmission(post["subreddit"], post["id"], 
+                           post["created_utc"], post["title"], 
+                           post.get("selftext", u"")))
+    return corpus
+
+def save_corpus(corpus, filename):
+    fp = open(filename, "w")
+    for submission in flatten(corpus):
+        fp.write(json.dumps({"subreddit": 
+                             cannedpostresponder.subname(submission),
+                             "id": submission.id, 
+                             "created_utc": submission.created_utc,
+                             "title": submission.title,
+                             "selftext": submission.selftext}) + "\n")
+    fp.close()
+
+def flatten(corpus):
+    """All the submissions in a corpus, oldest first."""
+    return sorted([submission for posts in corpus.values() 
+                   for submission in posts], 
+                  key = lambda submission: submission.created_utc)
+
+def truncate(corpus, count):
+    """The oldest count submissions in corpus."""
+    keep = set(submission.id for submission in flatten(corpus)[:count])
+    return dict((sub, [submission for submission in posts 
+                       if submission.id in keep]) 
+                for sub, posts in corpus.items())
+
+def instruction_costs(instructions, haystacks, top):
+    """Times each instruction's regex on its own against every haystack,
+    without the keyword index's help.  Returns the top most expensive, as 
+    (seconds per post, instruction) pairs."""
+    costs = []
+    for instruction in instructions:
+        search = instruction.re_compiled.search
+        start = time.time()
+        for text in haystacks:
+            search(text)
+        costs.append(((time.time() - start) / len(haystacks), 
+                      str(instruction)))
+    costs.sort(reverse = True)
+    return costs[:top]
+
+def run(corpus, instructions, args):
+    """Runs one benchmark in a scratch directory and returns its 
+    results."""
+    directory = tempfile.mkdtemp(prefix = "bench_cpr")
+    try:
+        relocate(directory)
+        settings = {"username": "bench", "password": "bench",
+                    "proprietor": "bench", "text_editor": "", 
+                    "log_reader": "", "email": "", "email_password": "",
+                    "recipients": [], "smtp_server": "", "smtp_port": 465,
+                    "subreddits": sorted(corpus), "sleep_time": 3600,
+                    "limit": max(len(posts) for posts in corpus.values()),
+                    "state_backend": args.state_backend,
+                    "request_rate": 1.0e9, "request_burst": 1.0e9,
+                    "match_processes": args.match_processes}
+        io_cpr.store_settings(cannedpostresponder.settings_file, settings)
+        open(cannedpostresponder.instructions_file, "w").write(instructions)
+        for rule in io_cpr.Instruction_Parser(
+                cannedpostresponder.instructions_file):
+            open(cannedpostresponder.path + eval(rule[2]), 
+                 "w").write("response")
+        results = {}
+        start = time.time()
+        cpr = BenchResponder(cannedpostresponder.settings_file)
+        results["load"] = time.time() - start
+        submissions = flatten(corpus)
+        results["posts"] = len(submissions)
+        start = time.time()
+        for submission in submissions:
+            cpr.wants_response(submission)
+        results["match"] = time.time() - start
+        results["evaluated"] = cpr.instructions.evaluated
+        cpr.instructions.reset_stats()
+        cpr.reddit = StubReddit(corpus)
+        start = time.time()
+        cpr.match_and_respond()
+        cpr.end_cycle()
+        results["cycle"] = time.time() - start
+        results["responses"] = len([submission for submission in submissions
+                                    if submission.reply is not None])
+        sample = [cannedpostresponder.haystack(submission) 
+                  for submission in submissions[:args.cost_sample]]
+        results["costs"] = instruction_costs(cpr.instructions, sample, 
+                                             args.top)
+        results["rules"] = len(cpr.instructions)
+        results["memory"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+def isolated(call, *args):
+    """Runs call(*args) in a child process, so that each benchmark's peak
+    memory use is its own, and returns what it returns."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            marshal.dump(call(*args), os.fdopen(write, "wb"))
+        except:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    os.close(write)
+    fp = os.fdopen(read, "rb")
+    try:
+        return marshal.load(fp)
+    except EOFError:
+        return None
+    finally:
+        fp.close()
+        os.waitpid(pid, 0)
+
+def per_second(count, seconds):
+    return count / seconds if seconds else float("inf")
+
+def report(results):
+    print ("%6d rules %8d posts  load %7.3fs  match %9.0f posts/s  "
+           "cycle %9.0f posts/s  %6.2f regexes/post  %5d responses  "
+           "peak RSS %d" % 
+           (results["rules"], results["posts"], results["load"],
+            per_second(results["posts"], results["match"]),
+            per_second(results["posts"], results["cycle"]),
+            float(results["evaluated"]) / max(results["posts"], 1),
+            results["responses"], results["memory"]))
+    for cost, instruction in results["costs"]:
+        print "        %9.2fus/post  %s" % (cost * 1.0e6, instruction)
+
+def bench_args():
+    parser = argparse.ArgumentParser(description = program_description)
+    parser.add_argument('--posts', nargs = '+', type = int, 
+                        default = [1000, 10000],
+                        help = ('corpus sizes to try; default is 1000 and '
+                                '10000'))
+    parser.add_argument('--rules', nargs = '+', type = int, 
+                        default = [10, 100, 1000],
+                        help = ('numbers of made up instructions to try; '
+                                'default is 10, 100 and 1000'))
+    parser.add_argument('--instructions', nargs = 1, type = str,
+                        help = ('use this instructions file instead of '
+                                'made up instructions'))
+    parser.add_argument('--corpus', nargs = 1, type = str,
+                        help = ('replay the submissions recorded in this '
+                                'file, one JSON object per line, instead of '
+                                'made up ones'))
+    parser.add_argument('--save_corpus', nargs = 1, type = str,
+                        help = ('write the largest made up corpus to this '
+                                'file, for replaying later'))
+    parser.add_argument('--subreddits', nargs = 1, type = int, default = [4],
+                        help = ('number of subreddits to spread made up '
+                                'submissions over; default is 4'))
+    parser.add_argument('--match_rate', nargs = 1, type = float, 
+                        default = [0.01],
+                        help = ('fraction of made up submissions that match '
+                                'an instruction; default is 0.01'))
+    parser.add_argument('--state_backend', choices = ['text', 'sqlite'],
+                        default = 'text',
+                        help = 'state backend to use; default is text')
+    parser.add_argument('--match_processes', nargs = 1, type = int, 
+                        default = [0],
+                        help = ('number of processes to match backlogs with; '
+                                'default is 0, for matching in the main '
+                                'process'))
+    parser.add_argument('--top', nargs = 1, type = int, default = [5],
+                        help = ('number of most expensive instructions to '
+                                'list for each run; default is 5'))
+    parser.add_argument('--cost_sample', nargs = 1, type = int, 
+                        default = [1000],
+                        help = ('number of submissions to time each '
+                                'instruction against; default is 1000'))
+    parser.add_argument('--seed', nargs = 1, type = int, default = [0],
+                        help = 'seed for making things up; default is 0')
+    args = parser.parse_args()
+    for name in ["subreddits", "match_rate", "match_processes", "top", 
+                 "cost_sample", "seed"]:
+        setattr(args, name, getattr(args, name)[0])
+    return args
+
+if __name__ == '__main__':
+    args = bench_args()
+    rand = random.Random(args.seed)
+    words = make_words(5000, rand)
+    if args.instructions:
+        rule_sets = [open(args.instructions[0], "r").read()]
+        samples = []
+    else:
+        # smaller instruction sets are the start of the largest one, so 
+        # they match the same corpus in the same way as far as they go
+        lines, samples = make_instructions(max(args.rules), words, rand)
+        rule_sets = ["\n".join(lines[:count]) + "\n" 
+                     for count in sorted(args.rules)]
+    if args.corpus:
+        full = load_corpus(args.corpus[0])
+    else:
+        full = make_corpus(max(args.posts), args.subreddits, words, 
+                           samples or words, args.match_rate, rand)
+        if args.save_corpus:
+            save_corpus(full, args.save_corpus[0])
+    for instructions in rule_sets:
+        for count in sorted(args.posts):
+            results = isolated(run, truncate(full, count), instructions, 
+                               args)
+            if results is None:
+                sys.exit(1)
+            report(results)
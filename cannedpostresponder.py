@@ -33,11 +33,22 @@ import os
 import praw
 import re
 import io_cpr
+import match_cpr
+import state_cpr
+import format_cpr
+import net_cpr
+import metrics_cpr
+import requests
+import smtplib
+import socket
 import argparse
 from email.mime.text import MIMEText
 import time
 import signal
 import logging
+import resource
+import collections
+import Queue
 
 __author__ = 'Charlie Pashayan'
 __version__ = '1.0.0'
@@ -51,7 +62,16 @@ path = os.path.dirname(os.path.abspath(__file__)) + os.sep
 alreadies_file = path + ".alreadies.txt"
 settings_file = path + ".settings.txt"
 instructions_file = path + ".instructions.txt"
+instructions_cache_file = path + ".instructions.cache"
 latest_file = path + ".latest.txt"
+state_db_file = path + ".state.db"
+bloom_file = path + ".alreadies.bloom"
+schedule_file = path + ".schedule.txt"
+match_stats_file = path + ".match_stats.txt"
+metrics_file = path + ".metrics.json"
+resume_file = path + ".resume.txt"
+response_log_file = path + ".responses.log"
+socket_file = path + ".cpr.sock"
 pid_file = path + ".pid.txt"
 source_file = path + "cannedpostresponder.py"
 
@@ -62,14 +82,51 @@ is_change = False
 
 pseudostop = signal.SIGUSR1
 pseudokill = signal.SIGUSR2
-sigchange = signal.SIGCHLD
+# not SIGCHLD: the match worker processes deliver that whenever they're
+# stopped, which would look like a change every time
+sigchange = signal.SIGHUP
 
 settings_vars = ['username', 'text_editor', 'log_reader', 'smtp_port',
 'recipients', 'email_password', 'password', 'subreddits', 'smtp_server',
 'sleep_time', 'proprietor', 'limit', 'email']
 
+# settings added since the first release, with the values used when an 
+# older settings file doesn't have them
+settings_defaults = {'state_backend': 'text', 'state_batch': 20,
+                     'bloom_capacity': 100000, 'bloom_error_rate': 0.001,
+                     'fetch_workers': 4, 'request_rate': 0.5, 
+                     'request_burst': 3, 'retry_attempts': 4, 
+                     'retry_base': 2.0, 'retry_cap': 60.0, 
+                     'retry_delay': 60, 'breaker_threshold': 3,
+                     'stream_window': 100, 'checkpoint_every': 100,
+                     'poll_min': 300, 'outbox_batch': 20,
+                     'digest_interval': 0, 'digest_count': 50,
+                     'smtp_idle': 240, 'stats_interval': 300, 
+                     'slow_match': 1.0, 'match_timeout': 0, 
+                     'match_strikes': 3, 'match_processes': 0,
+                     'match_batch': 200, 'drain_timeout': 30,
+                     'retention_days': 0, 'retention_count': 0,
+                     'compact_interval': 86400}
+
+# which settings call for which parts of CannedPostResponder to be 
+# reloaded when they change
+reddit_settings = set(['username', 'password', 'proprietor'])
+email_settings = set(['email', 'email_password', 'recipients', 'smtp_server',
+                      'smtp_port', 'outbox_batch', 'digest_interval', 
+                      'digest_count', 'smtp_idle'])
+state_settings = set(['state_backend', 'bloom_capacity', 'bloom_error_rate'])
+limit_settings = set(['request_rate', 'request_burst', 'poll_min', 
+                      'sleep_time'])
+match_settings = set(['match_timeout', 'match_strikes', 'match_processes'])
+
 RETRY_CODES = [502, 503, 504]
 
+# how many surplus lines the alreadies journal may hold before compaction
+compact_slack = 1000
+
+# how long a command from the control socket waits for the main thread
+command_wait = 30
+
 def sleep_handler(signum, frame):
     """Signal handler for pseudostop; tries to ensure
     that CannedPostResponder never stops while lock()ed."""
@@ -80,13 +137,14 @@ def sleep_handler(signum, frame):
         os.kill(os.getpid(), signal.SIGSTOP)
 
 def die_handler(signum, frame):
-    """Signal handler for pseudostop; tries to ensure
-    that CannedPostResponder never dies while lock()ed."""
+    """Signal handler for pseudokill, SIGTERM and SIGINT; asks 
+    CannedPostResponder to drain, finishing the submission in hand and
+    saving its progress before exiting.  A second signal exits at once,
+    unless CannedPostResponder is lock()ed."""
     global no_kill, please_die
-    if no_kill:
-        please_die = True
-    else:
-        terminate(0)
+    if please_die and not no_kill:
+        terminate(1)
+    please_die = True
 
 def register_change(signum, frame):
     """Signal handler for sigchange, the signal CannedPostResponder
@@ -112,14 +170,58 @@ def unlock():
     if please_stop:
         please_stop = False
         os.kill(os.getpid(), signal.SIGSTOP)
-    if please_die:
-        terminate(0)
 
 def terminate(exit_code):
     """Used to exit.  Importantly, cleans up pid_file."""
     os.remove(pid_file)
     os._exit(exit_code)
 
+def load_resume():
+    """The (subreddit, post) pairs saved by a run that stopped before 
+    responding to them."""
+    if os.path.exists(resume_file):
+        return [tuple(pair) for pair in format_cpr.load(resume_file, "resume")]
+    return []
+
+def save_resume(pending):
+    if pending:
+        format_cpr.dump(resume_file, "resume", pending)
+    elif os.path.exists(resume_file):
+        os.remove(resume_file)
+
+def today():
+    """The start of the current day, in seconds since the epoch; the text 
+    backend dates responses to the day."""
+    return int(time.time()) // 86400 * 86400
+
+def state_files(backend):
+    """The files the given state backend keeps its record in."""
+    if backend == "sqlite":
+        return [state_db_file, state_db_file + "-wal"]
+    return [alreadies_file, latest_file]
+
+def compact_state(alreadies, latest, policy, files):
+    """Forgets the responses and latest posts that policy says are no 
+    longer worth keeping, then rewrites what's left.  Returns a report of 
+    what was forgotten and how many bytes of the given files were 
+    reclaimed; a rewrite can leave the files a little bigger, say when it
+    dates responses that weren't, which counts as nothing reclaimed."""
+    before = sum(os.path.getsize(filename) for filename in files 
+                 if os.path.exists(filename))
+    dropped, removed = alreadies.prune(policy)
+    stale = [subreddit for subreddit in latest.done 
+             if not policy.keeps(subreddit)]
+    if stale:
+        latest.clear(stale)
+    if before:
+        alreadies.compact()
+    after = sum(os.path.getsize(filename) for filename in files 
+                if os.path.exists(filename))
+    return {"responses_removed": removed, "responses_kept": len(alreadies),
+            "subreddits_removed": sorted(set(dropped) | set(stale)),
+            "bytes_before": before, "bytes_after": after,
+            "bytes_reclaimed": max(before - after, 0)}
+
 def are_new():
     """Says whether some change has been made to CannedPostResponder's 
     ancillary files."""
@@ -142,6 +244,22 @@ def subname(submission):
         last = piece
     return ""
 
+def haystack(submission):
+    """Concatenates subreddit name, post title and body, separated by 
+    newlines; this way the user can specify where the string appears 
+    if needed."""
+    return "\n".join([unicode(s) for s in [subname(submission), 
+                                           submission.title, 
+                                           submission.selftext]])
+
+def is_transient(err):
+    """Says whether a failed request is worth trying again."""
+    if isinstance(err, requests.exceptions.HTTPError):
+        return err.response is not None and \
+            err.response.status_code in RETRY_CODES
+    return isinstance(err, (requests.exceptions.ConnectionError, 
+                            requests.exceptions.Timeout))
+
 class Instruction:
     """Stores the compiled regex, human readable regex (with flags) and
     the name of the text file containing the response to messages
@@ -157,24 +275,164 @@ class Instruction:
         return "%s %s" % (self.re_string, self.filename)
 
 class Alreadies:
-    def __init__(self, alreadiesstr = ""):
-        if alreadiesstr:
-            self.done = eval(alreadiesstr)
-        else:
-            self.done = {}
+    """The posts CannedPostResponder has already responded to, kept as a
+    dictionary per subreddit giving the day each post was responded to.
+    Each insertion is appended to a journal file as a "<subreddit> <post id>
+    <day>" line, so recording a response never means rewriting the whole 
+    history; the lines are only forced out to disk by sync().  Every so 
+    often the journal gets compacted down to one line per post."""
+    def __init__(self, journal = None):
+        self.done = {}
+        self.journal = journal
+        self.fp = None
+        self.lines = 0
+        if journal and os.path.exists(journal):
+            self.load()
+
+    def load(self):
+        """Reads the journal in a line at a time.  Journals written by 
+        older versions of CannedPostResponder, which hold a dictionary of 
+        lists or lack the header line, are converted on the spot.  Posts 
+        recorded without a day, which only those older journals have, are
+        dated today.  Lines cut off by a crash or otherwise garbled are 
+        skipped with a warning."""
+        fp = open(self.journal, "r")
+        first = fp.readline()
+        legacy = format_cpr.read_header(first, "alreadies") is None
+        if legacy:
+            if first.startswith("{"):
+                for subreddit, posts in format_cpr.load(
+                    self.journal, "alreadies", lambda value: value.items()):
+                    self.done.setdefault(subreddit, {}).update(
+                        dict.fromkeys(posts, today()))
+                fp.close()
+                self.compact()
+                return
+            fp.seek(0)
+        done = self.done
+        lines = 0
+        # every post from the same day shares one int
+        days = {}
+        undated = today()
+        skipped = 0
+        for line in fp:
+            pieces = line.split()
+            # a line without its newline was still being written when the
+            # bot died, so even its day may be cut short
+            if not line.endswith("\n"):
+                pieces = None
+            elif len(pieces) == 3:
+                day = days.get(pieces[2])
+                if day is None and pieces[2].isdigit():
+                    day = days[pieces[2]] = int(pieces[2])
+                if day is None:
+                    pieces = None
+            elif len(pieces) == 2 and legacy:
+                day = undated
+            else:
+                pieces = None
+            if pieces is None:
+                if line.strip():
+                    skipped += 1
+                continue
+            subreddit, post = pieces[0], pieces[1]
+            if subreddit not in done:
+                done[subreddit] = {}
+            done[subreddit][post] = day
+            lines += 1
+        fp.close()
+        if skipped:
+            logging.warning("Skipped %d incomplete or garbled lines in %s", 
+                            skipped, self.journal)
+        # compaction gets rid of them too
+        self.lines = lines + skipped
 
     def __contains__(self, submission):
         subreddit, post = subname(submission), submission.id
         return subreddit in self.done and \
             post in self.done[subreddit]
 
-    def insert(self, submission):
-        subreddit, post = subname(submission), submission.id
-        if subreddit in self.done:
-            if submission not in self.done[subreddit]:
-                self.done[subreddit].append(post)
-        else:
-            self.done[subreddit] = [post]
+    def __len__(self):
+        return sum(len(posts) for posts in self.done.values())
+
+    def insert(self, submission, response = None):
+        """Records a response to submission.  The name of the response is
+        only kept by the database backend."""
+        self.add(subname(submission), submission.id, response)
+
+    def add(self, subreddit, post, response = None):
+        posts = self.done.setdefault(subreddit, {})
+        if post in posts:
+            return
+        posts[post] = today()
+        if self.journal:
+            self.append(subreddit, post, posts[post])
+
+    def append(self, subreddit, post, day):
+        """Writes one entry to the end of the journal."""
+        if not self.fp:
+            self.fp = open(self.journal, "a+")
+            self.fp.seek(0, os.SEEK_END)
+            if not self.fp.tell():
+                self.fp.write(format_cpr.header("alreadies"))
+            else:
+                # make sure a partial line from a crash stays on its own
+                self.fp.seek(-1, os.SEEK_END)
+                if self.fp.read(1) != "\n":
+                    self.fp.write("\n")
+        self.fp.write("%s %s %d\n" % (subreddit, post, day))
+        self.lines += 1
+
+    def sync(self):
+        """Makes sure everything appended to the journal is on disk."""
+        if self.fp:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+    def compact(self):
+        """Rewrites the journal with exactly one line per post, replacing
+        the old one only once the new one is safely written."""
+        self.close()
+        temp = self.journal + ".tmp"
+        fp = open(temp, "w")
+        fp.write(format_cpr.header("alreadies"))
+        for subreddit in self.done:
+            for post, day in self.done[subreddit].items():
+                fp.write("%s %s %d\n" % (subreddit, post, day))
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.rename(temp, self.journal)
+        self.lines = len(self)
+
+    def prune(self, policy):
+        """Forgets the posts that policy says are no longer worth keeping, 
+        returning the subreddits forgotten altogether and how many posts 
+        were forgotten.  The journal still has them until compact()."""
+        dropped = []
+        removed = 0
+        for subreddit in list(self.done):
+            posts = self.done[subreddit]
+            if not policy.keeps(subreddit):
+                dropped.append(subreddit)
+                removed += len(posts)
+                del self.done[subreddit]
+                continue
+            for post in policy.expired(posts):
+                del posts[post]
+                removed += 1
+        return dropped, removed
+
+    def compact_if_wasteful(self):
+        """Compacts the journal if it has grown well beyond one line per 
+        post."""
+        if self.journal and self.lines > 2 * len(self) + compact_slack:
+            self.compact()
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
 
     def __str__(self):
         return str(self.done)
@@ -182,9 +440,11 @@ class Alreadies:
 class Latest:
     """A dicionary of the most recent posts examined for responsded to,
     used to avoid checking the same posts twice."""
-    def __init__(self, lateststr = ""):
-        if lateststr:
-            self.done = eval(lateststr)
+    def __init__(self, filename = None):
+        self.filename = filename
+        if filename and os.path.exists(filename):
+            self.done = dict((subreddit, tuple(post)) for subreddit, post 
+                             in format_cpr.load_dict(filename, "latest").items())
         else:
             self.done = {}
 
@@ -195,15 +455,125 @@ class Latest:
             return None
         
     def insert(self, submission):
-        subreddit = subname(submission) 
-        title = submission.id
-        time = submission.created_utc
+        self.advance(subname(submission), submission.id, 
+                     submission.created_utc)
+
+    def advance(self, subreddit, title, time):
+        """Makes title the latest post in subreddit, unless a more recent
+        one has already been seen."""
         if subreddit not in self.done or time >= self.done[subreddit][1]:
             self.done[subreddit] = (title, time)
+
+    def save(self):
+        format_cpr.dump_dict(self.filename, "latest", self.done)
+
+    def clear(self, subreddits = None):
+        """Forgets the latest posts for the given subreddits, or for all 
+        of them."""
+        if subreddits is None:
+            self.done = {}
+        else:
+            for subreddit in subreddits:
+                self.done.pop(subreddit, None)
+        self.save()
     
     def __str__(self):
         return str(self.done)
 
+class SQLiteLatest(Latest):
+    """Latest, kept in the state database instead of the latest file.
+    Reads go straight to the database so that changes made by cpr_admin.py
+    are seen right away."""
+    def __init__(self, db):
+        self.db = db
+
+    @property
+    def done(self):
+        return self.db.all_latest()
+
+    def latest(self, subreddit):
+        found = self.db.latest(subreddit)
+        return found[0] if found else None
+
+    def advance(self, subreddit, post, created_utc):
+        found = self.db.latest(subreddit)
+        if not found or created_utc >= found[1]:
+            self.db.set_latest(subreddit, post, created_utc)
+
+    def save(self):
+        # rows are written as they're inserted and committed by the caller
+        pass
+
+    def clear(self, subreddits = None):
+        self.db.clear_latest(subreddits)
+
+class SQLiteAlreadies(Alreadies):
+    """Alreadies, kept in the responses table of the state database, 
+    along with the name of the response posted and when.  If given a
+    Bloom filter, only posts that get past it are looked up in the 
+    database."""
+    def __init__(self, db, bloom = None):
+        self.db = db
+        self.bloom = bloom
+
+    def __contains__(self, submission):
+        subreddit, post = subname(submission), submission.id
+        if self.bloom is not None and \
+                state_cpr.bloom_key(subreddit, post) not in self.bloom:
+            return False
+        return self.db.has_response(subreddit, post)
+
+    def __len__(self):
+        return self.db.count_responses()
+
+    def add(self, subreddit, post, response = None):
+        self.db.add_response(subreddit, post, response)
+        if self.bloom is not None:
+            self.bloom.add(state_cpr.bloom_key(subreddit, post))
+            if self.bloom.full():
+                self.bloom = state_cpr.build_bloom(self.db, 
+                                                   self.bloom.capacity * 2,
+                                                   self.bloom.error_rate)
+
+    def save_filter(self):
+        """Saves the Bloom filter; call only right after committing, so
+        the saved filter matches what's in the database."""
+        if self.bloom is not None:
+            self.bloom.save(bloom_file, self.db.fingerprint())
+
+    def prune(self, policy):
+        dropped = []
+        removed = 0
+        for subreddit in self.db.response_subreddits():
+            if not policy.keeps(subreddit):
+                dropped.append(subreddit)
+                removed += self.db.forget_responses(subreddit)
+            else:
+                removed += self.db.forget_responses(
+                    subreddit, 
+                    policy.expired(self.db.response_times(subreddit)))
+        if removed and self.bloom is not None:
+            # a Bloom filter can't forget, so start over
+            self.bloom = state_cpr.build_bloom(self.db, self.bloom.capacity,
+                                               self.bloom.error_rate)
+        return dropped, removed
+
+    def compact(self):
+        self.db.vacuum()
+
+    def compact_if_wasteful(self):
+        pass
+
+    def sync(self):
+        # committed by the caller
+        pass
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return "%d responses in %s" % (len(self), self.db.filename)
+
 class CannedPostResponder:
     """The thing itself.  Reads through posts on Reddit, examines posts to see
     if they match a set of regexes.  Each regex is matched with a text file.
@@ -212,7 +582,22 @@ class CannedPostResponder:
     def __init__(self, settings_file = None):
         """Pushes off most of the work to get_set(), which is necessary
         as it is liable to be called multiple times."""
-        self.sleep_multiplier = 1
+        self.breakers = {}
+        self.smtp = None
+        self.db = None
+        self.alreadies = None
+        self.signatures = {}
+        self.response_log = state_cpr.ResponseLog(response_log_file)
+        self.stats_saved = 0
+        self.compacted = 0
+        self.pool = None
+        self.metrics = metrics_cpr.Metrics()
+        self.server = None
+        # commands from the control socket for the main thread to carry out
+        self.queue = Queue.Queue()
+        self.paused = False
+        self.draining = False
+        self.woken = False
         if settings_file:
             self.get_set(settings_file)
         return
@@ -220,6 +605,101 @@ class CannedPostResponder:
     def get_set(self, settings_file):
         """Read in the settings file and configure CannedPostResponder 
         accordingly."""
+        self.settings_file = settings_file
+        self.read_settings(settings_file)
+        self.load_instructions()
+        self.load_messages()
+        self.open_state()
+        self.open_smtp()
+        self.set_limits()
+        self.take_signatures(settings_file)
+
+    def reload(self, settings_file):
+        """Like get_set(), but only reloads what has changed since the files
+        were last read.  So editing a message file just rereads that file,
+        and the Reddit login is only redone if the Reddit account settings
+        have changed."""
+        changed = set(filename for filename in self.signatures
+                      if io_cpr.signature(filename) != 
+                      self.signatures[filename])
+        if settings_file in changed:
+            self.reread_settings(settings_file)
+        if instructions_file in changed:
+            logging.info("Reloading instructions.")
+            self.load_instructions()
+            self.load_messages()
+        else:
+            self.load_messages([filename for filename in self.messages
+                                if path + filename in changed])
+        if latest_file in changed:
+            # cpr_admin.py --clear_latest edits the file directly
+            self.reload_latest()
+        self.take_signatures(settings_file)
+
+    def reread_settings(self, settings_file):
+        """Reads the settings file again, redoing whatever depends on the
+        settings that have changed."""
+        old = self.settings
+        self.read_settings(settings_file)
+        different = set(setting for setting in self.settings 
+                        if self.settings[setting] != old.get(setting))
+        logging.info("Settings changed: %s", 
+                     ", ".join(sorted(different)) or "none")
+        if different & reddit_settings:
+            self.connect()
+        if different & state_settings:
+            self.open_state()
+        if different & email_settings:
+            self.open_smtp()
+        if different & limit_settings:
+            self.set_limits()
+        self.instructions.slow = self.slow_match
+        if different & match_settings:
+            self.instructions.set_guard(self.match_timeout, 
+                                        self.match_strikes)
+            self.open_pool()
+
+    def reload_component(self, component = None):
+        """Rereads one part of CannedPostResponder's setup, whether or not
+        its files have changed: settings, instructions, messages, state or
+        latest.  With no component, reloads whatever has changed, as 
+        reload() does."""
+        reloaders = {"settings": 
+                     lambda: self.reread_settings(self.settings_file),
+                     "instructions": lambda: (self.load_instructions(), 
+                                              self.load_messages()),
+                     "messages": self.load_messages,
+                     "state": self.open_state,
+                     "latest": self.reload_latest}
+        if component is None:
+            self.reload(self.settings_file)
+        elif component in reloaders:
+            logging.info("Reloading %s.", component)
+            reloaders[component]()
+            self.take_signatures(self.settings_file)
+        else:
+            raise ValueError("no such component as %s; try one of %s" % 
+                             (component, ", ".join(sorted(reloaders))))
+        return {"reloaded": component or "changes"}
+
+    def reload_latest(self):
+        if not self.db:
+            self.latest = Latest(latest_file)
+
+    def take_signatures(self, settings_file):
+        """Notes the contents of every file reload() keeps an eye on."""
+        watched = [settings_file, instructions_file, latest_file]
+        watched.extend([path + filename for filename in self.messages])
+        self.signatures = dict((filename, io_cpr.signature(filename)) 
+                               for filename in watched)
+
+    def sign_latest(self):
+        """Notes the signature of the latest file after CannedPostResponder
+        has written it itself, so reload() only rereads the file when 
+        cpr_admin.py has changed it."""
+        self.signatures[latest_file] = io_cpr.signature(latest_file)
+
+    def read_settings(self, settings_file):
         settings = io_cpr.get_settings(settings_file)
         for setting in settings_vars:
             try:
@@ -228,10 +708,43 @@ class CannedPostResponder:
                 logging.error("%s not present in settings file.  Terminating.",
                               setting)
                 terminate(1)
+        for setting in settings_defaults:
+            settings.setdefault(setting, settings_defaults[setting])
+            setattr(self, setting, settings[setting])
+        # the rate limiter waits 1 / request_rate seconds per token
+        if not self.request_rate > 0:
+            logging.error("request_rate must be more than 0, not %s.  "
+                          "Terminating.", self.request_rate)
+            terminate(1)
+        self.settings = settings
+        self.user_agent = ('CannedPostResponder %s '
+                           'operated by %s '
+                           'writtn by %s' % (__version__, 
+                                             self.proprietor, 
+                                             __author__))
+
+    def load_instructions(self):
         try:
-            ip = io_cpr.Instruction_Parser(instructions_file)
-            self.instructions = [Instruction(i[0], i[1], i[2]) for 
-                                 i in ip]
+            cache = match_cpr.InstructionCache(instructions_cache_file)
+            rules = cache.parse(instructions_file)
+            old = getattr(self, "instructions", None)
+            self.instructions = match_cpr.InstructionSet(
+                [Instruction(i[0], i[1], i[2]) for i in rules], cache.literals,
+                self.slow_match)
+            cache.save(self.instructions.literals)
+            self.instructions.set_guard(self.match_timeout, 
+                                        self.match_strikes)
+            if old is not None:
+                self.instructions.adopt_profile(old.profile, old.since, 
+                                                old.strikes)
+                old.close()
+            else:
+                stats = match_cpr.load_profile(match_stats_file)
+                if stats is not None:
+                    self.instructions.adopt_profile(
+                        dict(stats["instructions"]), stats["since"],
+                        stats.get("strikes", {}))
+            self.open_pool()
         except io_cpr.parseError as err:
             logging.error("Could not parse instructions file.  Terminating")
             terminate(1)
@@ -240,11 +753,30 @@ class CannedPostResponder:
                 # file doesn't exist
                 logging.error("Instructions file not found.  Terminating.")
                 terminate(1)
-        self.messages = {}
-        for instruction in self.instructions:
-            message_file = path + instruction.filename
+
+    def open_pool(self):
+        """Starts match_processes worker processes for matching big 
+        backlogs, if called for.  They aren't used along with 
+        match_timeout, since a pool worker can't be stopped in the middle
+        of a search."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.match_processes and not self.match_timeout:
+            self.pool = match_cpr.MatchPool(self.instructions, 
+                                            self.match_processes)
+
+    def load_messages(self, filenames = None):
+        """Reads in the named message files, or all the ones the 
+        instructions call for."""
+        if filenames is None:
+            self.messages = {}
+            filenames = [instruction.filename 
+                         for instruction in self.instructions]
+        for filename in filenames:
+            message_file = path + filename
             try:
-                self.messages[instruction.filename] = \
+                self.messages[filename] = \
                     open(message_file, 'r').read().rstrip()
             except IOError as err:
                 if err.errno == 2:
@@ -253,33 +785,324 @@ class CannedPostResponder:
                                    "Terminating."), 
                                   message_file)
                     terminate(1)
-        if os.path.exists(latest_file):
-            latest_text = open(latest_file, "r").read()
-        else:
-            latest_text = ""
-        self.latest = Latest(latest_text)
-        if os.path.exists(alreadies_file):
-            alreadies_text = open(alreadies_file, "r").read()
-        else:
-            alreadies_text = ""
-        self.alreadies = Alreadies(alreadies_text)
+
+    def open_smtp(self):
+        if self.smtp:
+            self.smtp.close()
         self.smtp = io_cpr.CPR_SMTP(host = self.smtp_server, 
-                                    port = self.smtp_port)
+                                    port = self.smtp_port,
+                                    batch = self.outbox_batch,
+                                    digest_interval = self.digest_interval,
+                                    digest_count = self.digest_count,
+                                    idle = self.smtp_idle,
+                                    metrics = self.metrics)
         self.email_on = False
         if self.email:
+            self.smtp.set_recipients(self.recipients)
             try:
                 self.smtp.login(self.email, self.email_password)
-                self.smtp.set_recipients(self.recipients)
-                self.email_on = True
-            except Exception as err:
+            except smtplib.SMTPAuthenticationError as err:
                 logging.error("Could not log into email as %s\nError: %s", 
                               self.email, str(err))
                 terminate(1)
-        self.user_agent = ('CannedPostResponder %s '
-                           'operated by %s '
-                           'writtn by %s' % (__version__, 
-                                             self.proprietor, 
-                                             __author__))
+            except (smtplib.SMTPException, socket.error) as err:
+                # the outbox will keep trying
+                logging.warning("Could not reach %s: %s\nEmail will wait "
+                                "in the outbox.", self.smtp_server, str(err))
+            self.smtp.start()
+            self.email_on = True
+
+    def set_limits(self):
+        """Sets up the rate limiter and polling schedule."""
+        self.bucket = net_cpr.TokenBucket(self.request_rate, 
+                                          self.request_burst, self.metrics)
+        if hasattr(self, "scheduler"):
+            self.scheduler.shortest = self.poll_min
+            self.scheduler.longest = self.sleep_time
+        else:
+            self.scheduler = net_cpr.PollScheduler(schedule_file, 
+                                                   self.poll_min,
+                                                   self.sleep_time)
+
+    def open_state(self):
+        """Load the record of latest posts and responses from whichever
+        backend the settings call for.  The first time the database backend
+        is used, whatever is in the old text files is imported into it.
+        Any responses left in the response log by a crash are then 
+        recorded."""
+        if self.alreadies is not None:
+            self.save_state()
+            self.alreadies.close()
+        if self.db:
+            self.db.close()
+            self.db = None
+        self.unsaved = 0
+        if self.state_backend == "sqlite":
+            self.db = state_cpr.StateDB(state_db_file)
+            if not self.db.migrated():
+                self.db.migrate(Latest(latest_file).done, 
+                                Alreadies(alreadies_file).done)
+            bloom = None
+            if self.bloom_capacity:
+                bloom = state_cpr.load_bloom(bloom_file, self.db,
+                                             self.bloom_capacity, 
+                                             self.bloom_error_rate)
+            self.latest = SQLiteLatest(self.db)
+            self.alreadies = SQLiteAlreadies(self.db, bloom)
+        else:
+            self.latest = Latest(latest_file)
+            self.alreadies = Alreadies(alreadies_file)
+        self.recover_responses()
+
+    def recover_responses(self):
+        """Records the responses in the response log as posted.  They were
+        about to be posted, or had been, when CannedPostResponder stopped
+        without saving them, and it's better to miss one than to post it 
+        twice."""
+        pending = self.response_log.pending()
+        if pending:
+            logging.warning("Recording %d responses that may have been posted "
+                            "just before CannedPostResponder last stopped: %s",
+                            len(pending), ", ".join(["%s in %s" % (post, sub) 
+                                                     for sub, post in pending]))
+            for subreddit, post in pending:
+                self.alreadies.add(subreddit, post)
+        self.save_state()
+
+    def record_response(self, submission, instruction):
+        """Note that submission has been responded to.  The record is saved
+        every state_batch responses; until then the response log is what 
+        keeps them from being posted again."""
+        self.latest.insert(submission)
+        self.alreadies.insert(submission, instruction.filename)
+        self.unsaved += 1
+        if self.unsaved >= self.state_batch:
+            self.save_state()
+
+    def save_state(self):
+        """Saves the latest posts and the responses recorded since the last
+        save, then empties the response log, which has nothing left to 
+        protect."""
+        if self.db:
+            self.db.commit()
+        else:
+            self.alreadies.sync()
+            self.latest.save()
+            self.sign_latest()
+        self.unsaved = 0
+        self.response_log.clear()
+
+    def end_cycle(self, started = None):
+        """Housekeeping after a pass over all the subreddits, which began
+        at started."""
+        if started:
+            self.metrics.observe("cycle_seconds", time.time() - started)
+        self.save_metrics()
+        self.log_match_stats()
+        if time.time() - self.stats_saved >= self.stats_interval:
+            self.instructions.save_profile(match_stats_file)
+            self.stats_saved = time.time()
+        self.save_state()
+        if self.compact_interval and self.retention_policy().enabled() and \
+                time.time() - self.compacted >= self.compact_interval:
+            self.compact()
+        self.alreadies.compact_if_wasteful()
+        if self.db:
+            self.alreadies.save_filter()
+        self.scheduler.save()
+        self.log_memory()
+        logging.info("Rate limiter: %s", str(self.bucket) or "no requests")
+        self.bucket.reset_stats()
+
+    def save_metrics(self):
+        """Brings the gauges up to date and saves a snapshot of the 
+        metrics."""
+        for sub in self.subreddits:
+            breaker = self.breaker(sub)
+            self.metrics.gauge("breaker_failures", breaker.failures, sub)
+            self.metrics.gauge("breaker_open_until", breaker.open_until, sub)
+            self.metrics.gauge("next_poll", self.scheduler.next_poll(sub), 
+                               sub)
+        if self.email_on:
+            self.metrics.gauge("outbox_pending", 
+                               len(self.smtp.outbox.pending()))
+        self.metrics.gauge("peak_memory", resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss)
+        self.metrics.save(metrics_file)
+
+    def listen(self):
+        """Starts answering requests from cpr_admin.py on socket_file.
+        Commands that touch CannedPostResponder's state are queued for the
+        main thread, which carries them out between subreddits and while
+        sleeping."""
+        commands = {"metrics": self.metrics.snapshot,
+                    "status": self.status,
+                    "pause": self.pause,
+                    "resume": self.resume,
+                    "drain": self.drain,
+                    "stats": self.queued(self.stats),
+                    "reload": self.queued(self.reload_component),
+                    "clear_latest": self.queued(self.clear_latest),
+                    "compact": self.queued(self.compact)}
+        try:
+            self.server = metrics_cpr.CommandServer(socket_file, commands)
+        except socket.error as err:
+            logging.warning("Could not listen on %s: %s", socket_file, 
+                            str(err))
+
+    def queued(self, command):
+        """Wraps command so that calling it from the socket's thread has
+        the main thread carry it out.  Waits up to command_wait seconds
+        for the result; if the main thread is too busy, says the command 
+        has been queued."""
+        def call(*args):
+            reply = Queue.Queue()
+            self.queue.put((command, args, reply))
+            try:
+                return reply.get(timeout = command_wait)
+            except Queue.Empty:
+                return {"queued": True}
+        return call
+
+    def serve_commands(self, timeout = 0):
+        """Carries out queued commands, waiting up to timeout seconds for 
+        one to arrive."""
+        block = timeout > 0
+        while True:
+            try:
+                command, args, reply = self.queue.get(block, timeout)
+            except Queue.Empty:
+                return
+            block = False
+            try:
+                result = command(*args)
+            except Exception as err:
+                logging.exception("Command failed")
+                result = {"error": str(err)}
+            if reply is not None:
+                reply.put(result)
+
+    def wake(self):
+        """Interrupts the main thread's wait()."""
+        self.woken = True
+        self.queue.put((lambda: None, (), None))
+
+    def wait(self, seconds):
+        """Sleeps for seconds, carrying out commands as they come in, 
+        unless woken by being paused, resumed or told to drain."""
+        deadline = time.time() + seconds
+        while not self.woken and not self.should_stop() and \
+                time.time() < deadline:
+            # not too long at a time, so signals are noticed
+            self.serve_commands(min(deadline - time.time(), 1))
+        self.woken = False
+
+    def should_stop(self):
+        """Whether CannedPostResponder has been told to drain, over the 
+        socket or by a signal."""
+        return self.draining or please_die
+
+    def status(self):
+        return {"pid": os.getpid(), "paused": self.paused, 
+                "draining": self.should_stop(), 
+                "started": self.metrics.started}
+
+    def pause(self):
+        """Stops work after the subreddit in hand, until resume()."""
+        self.paused = True
+        self.wake()
+        return self.status()
+
+    def resume(self):
+        self.paused = False
+        self.wake()
+        return self.status()
+
+    def drain(self):
+        """Stops work after the submission in hand and shuts down cleanly."""
+        self.draining = True
+        self.wake()
+        return self.status()
+
+    def stats(self):
+        """What CannedPostResponder has in memory, for cpr_admin.py."""
+        return {"status": self.status(),
+                "subreddits": dict((sub, {"latest": self.latest.latest(sub),
+                                          "breaker": str(self.breaker(sub)),
+                                          "next_poll": 
+                                          self.scheduler.next_poll(sub)})
+                                   for sub in self.subreddits),
+                "responses": len(self.alreadies),
+                "instructions": len(self.instructions),
+                "quarantined": [str(self.instructions[number]) for number
+                                in sorted(self.instructions.quarantined)],
+                "rate_limiter": str(self.bucket),
+                "metrics": self.metrics.snapshot()}
+
+    def retention_policy(self):
+        return state_cpr.RetentionPolicy(self.retention_days, 
+                                         self.retention_count,
+                                         self.subreddits, self.limit)
+
+    def compact(self):
+        """Forgets what the retention policy says is no longer worth 
+        keeping and compacts the record of responses; done every 
+        compact_interval seconds, and by cpr_admin.py --compact."""
+        self.save_state()
+        report = compact_state(self.alreadies, self.latest, 
+                               self.retention_policy(),
+                               state_files(self.state_backend))
+        self.save_state()
+        if self.db:
+            self.alreadies.save_filter()
+        self.compacted = time.time()
+        self.metrics.count("responses_pruned", report["responses_removed"])
+        logging.info("Compacted the record of responses: forgot %d, kept %d "
+                     "and reclaimed %d bytes.  Subreddits forgotten: %s",
+                     report["responses_removed"], report["responses_kept"],
+                     report["bytes_reclaimed"], 
+                     ", ".join(report["subreddits_removed"]) or "none")
+        return report
+
+    def clear_latest(self, *subreddits):
+        """Forgets the latest posts for the given subreddits, or all of 
+        them, so they're searched again up to limit."""
+        self.latest.clear(list(subreddits) or None)
+        self.sign_latest()
+        return {"cleared": list(subreddits) or "all"}
+
+    def shutdown(self):
+        """Saves everything, gives the outbox up to drain_timeout seconds
+        to send what's waiting in it, and stops the helper threads and 
+        processes, for a clean exit."""
+        logging.info("Shutting down.")
+        self.save_state()
+        if self.db:
+            self.alreadies.save_filter()
+        self.scheduler.save()
+        self.instructions.save_profile(match_stats_file)
+        self.save_metrics()
+        self.alreadies.close()
+        if self.db:
+            self.db.close()
+        if self.pool is not None:
+            self.pool.close()
+        self.instructions.close()
+        if self.email_on:
+            self.smtp.flush(self.drain_timeout)
+        self.smtp.close()
+        if self.server is not None:
+            self.server.close()
+
+    def log_memory(self):
+        """Records how much memory the process and the dedupe filter use."""
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.db and self.alreadies.bloom is not None:
+            logging.info("Peak memory use %d (ru_maxrss); dedupe filter: %s",
+                         peak, self.alreadies.bloom)
+        else:
+            logging.info("Peak memory use %d (ru_maxrss); %d responses "
+                         "held in memory", peak, len(self.alreadies))
 
     def connect(self):
         """Connect CannedPostResponder to Reddit."""
@@ -301,7 +1124,16 @@ class CannedPostResponder:
         """Forward PMs and responses to personal address."""
         if not self.email_on:
             return
-        for msg in self.reddit.get_unread(limit = None):
+        try:
+            unread = self.with_retries(lambda: list(self.bucket.metered(
+                        self.reddit.get_unread(limit = None), 
+                        net_cpr.INBOX)))
+        except Exception as err:
+            if not is_transient(err):
+                raise
+            logging.error("Could not retrieve messages: %s", str(err))
+            return
+        for msg in unread:
             if are_new():
                 return
             lock()
@@ -310,92 +1142,313 @@ class CannedPostResponder:
                             msg.author))
             try:
                 self.smtp.forward_message(msg)
-            except smtplib.SMTPException as err:
+            except EnvironmentError as err:
                 logging.warning(('Could not email message: %s\n'
                                  '%s'), str(err), msg)
-            msg.mark_as_read()
+            try:
+                self.with_retries(lambda: self.mark_as_read(msg))
+            except Exception as err:
+                if not is_transient(err):
+                    raise
+                logging.error("Could not mark message as read: %s", str(err))
             unlock()
 
+    def mark_as_read(self, msg):
+        self.bucket.take(net_cpr.INBOX)
+        msg.mark_as_read()
+
     def wants_response(self, submission):
         """Determine whether a submission is eligible for a response
         and which response is needed.  Returns either the name of
         the appropriate response or None."""
         if submission in self.alreadies:
             return None
-        for instruction in self.instructions:
-            pattern = instruction.re_compiled
-            # concatenate subreddit name, post title and body, separated by 
-            # newlines this way the user can specify where the string appears 
-            # if needed
-            bigstr = "\n".join([unicode(s) for s in [subname(submission), 
-                                                 submission.title, 
-                                                 submission.selftext]])
-            if pattern.search(bigstr):
-                return instruction
-        return None
+        return self.instructions.match(haystack(submission))
+
+    def log_match_stats(self):
+        """Records how many regex evaluations the keyword index saved
+        during the last cycle, then starts counting afresh."""
+        evaluated = self.instructions.evaluated
+        skipped = self.instructions.skipped
+        if evaluated or skipped:
+            logging.info("Keyword index skipped %d of %d regex evaluations.",
+                         skipped, evaluated + skipped)
+        self.instructions.reset_stats()
+
+    def fetch_new(self, job, put):
+        """Retrieves the new submissions for one (subreddit, latest) job,
+        handing each to put() as it arrives.  If the listing has to be 
+        retried, submissions already handed over are skipped.  Runs on a 
+        fetch thread, so it mustn't touch CannedPostResponder's state."""
+        sub, latest = job
+        # if digging for latest don't bother with numerical limit
+        limit = None if latest else self.limit
+        subreddit = self.reddit.get_subreddit(sub)
+        delivered = set()
+        # time spent waiting for matching to catch up, which isn't Reddit's
+        # fault
+        blocked = [0.0]
+
+        def attempt():
+            listing = subreddit.get_new(place_holder = latest, limit = limit)
+            for submission in self.bucket.metered(listing, net_cpr.FETCH):
+                if submission.id not in delivered:
+                    delivered.add(submission.id)
+                    start = time.time()
+                    put(submission)
+                    blocked[0] += time.time() - start
+        start = time.time()
+        self.with_retries(attempt)
+        self.metrics.observe("fetch_seconds", 
+                             time.time() - start - blocked[0], sub)
+
+    def with_retries(self, call):
+        """Calls call(), retrying with backoff if it fails for reasons
+        that are likely to pass."""
+        def retriable(err):
+            transient = is_transient(err)
+            if transient:
+                self.metrics.count("transient_errors")
+            return transient
+        return net_cpr.retry(call, retriable, self.retry_attempts,
+                             self.retry_base, self.retry_cap)
 
     def match_and_respond(self):
         """Scans posts in relevant subreddits, responding to the ones that 
         match with the preset response.  Note that only the response associated
-        with the first matching regular expression will be posted."""
-        for sub in self.subreddits:
-            latest = self.latest.latest(sub)
-            subreddit = self.reddit.get_subreddit(sub)
-            limit = None if latest else self.limit
-            # if digging for latest don't bother with numerical limit
+        with the first matching regular expression will be posted.  Subreddits
+        are fetched concurrently but their posts are matched and responded to
+        one subreddit at a time, in order.  A subreddit that can't be reached
+        is skipped without holding up the others.  Only the subreddits the
+        scheduler says are due get polled."""
+        jobs = [(sub, self.latest.latest(sub)) for sub in self.subreddits
+                if self.breaker(sub).allow() and self.scheduler.due(sub)]
+        fetched = net_cpr.fetch_concurrently(jobs, self.fetch_new, 
+                                             self.fetch_workers, 
+                                             self.stream_window,
+                                             self.should_stop)
+        for (sub, latest), stream in fetched:
             try:
-                submissions = list(subreddit.get_new(place_holder = latest, 
-                                                     limit = limit))
+                scanned, matched = self.scan(latest, stream)
+                if scanned is None:
+                    return
             except praw.errors.InvalidSubreddit:
                 logging.warning("%s is not a valid subreddit.", sub)
                 self.subreddits.remove(sub)
                 continue
-            except requests.exceptions.HTTPError as err:
-                logging.error(err.errstr)
-                if err.response.status_code in RETRY_CODES:
-                    self.sleep_multiplier += 1
-                    return
-                else:
+            except Exception as err:
+                if not is_transient(err):
                     raise
-            except requests.exceptions.ConnectionError as err:
-                logging.error(err.errstr)
-                self.sleep_multiplier += 1
+                self.breaker(sub).failure()
+                self.scheduler.postpone(sub, self.retry_delay)
+                self.metrics.count("fetch_failures", 1, sub)
+                logging.error("Could not fetch %s: %s\nCircuit breaker %s", 
+                              sub, str(err), self.breaker(sub))
+                continue
+            self.scheduler.observe(sub, [created for created, post 
+                                         in scanned])
+            self.metrics.count("scanned", len(scanned), sub)
+            self.metrics.count("matched", len(matched), sub)
+            if not self.respond(sub, scanned, matched):
+                return
+            self.serve_commands()
+            if self.paused or self.should_stop():
                 return
-            newest = None
-            for submission in reversed(list(submissions)):
+
+    def scan(self, latest, stream):
+        """Matches submissions as they come in from the fetch thread.  Only
+        the ones that need a response are held on to; for the rest, just
+        the creation time and id are kept, for checkpointing.  With a pool
+        of matching processes, submissions are matched in batches of 
+        match_batch by the pool, and whatever's left over at the end is 
+        matched here.  Returns the (created_utc, id) of every submission, 
+        oldest first, and a dictionary from the ids of matching submissions
+        to (submission, instruction) pairs.  If told to stop before the 
+        stream runs out, returns (None, None); latest isn't moved up, so 
+        the submissions are fetched again next time."""
+        scanned = []
+        matched = {}
+        batch = []
+        pending = collections.deque()
+        try:
+            for submission in stream:
+                if self.should_stop():
+                    return None, None
                 if submission.id == latest:
                     continue
+                scanned.append((submission.created_utc, submission.id))
+                if self.pool is not None:
+                    if submission not in self.alreadies:
+                        batch.append(submission)
+                    if len(batch) >= self.match_batch:
+                        pending.append((batch, self.pool.submit(
+                                    [haystack(post) for post in batch])))
+                        batch = []
+                    # keep the pool busy, without too much waiting on it
+                    while pending and (pending[0][1].ready() or 
+                                       len(pending) > 
+                                       2 * self.match_processes):
+                        self.collect(pending.popleft(), matched)
+                    continue
                 instruction = self.wants_response(submission)
                 if instruction:
-                    if are_new():
-                        return
-                    lock()
-                    msg = self.messages[instruction.filename]
-                    try:
-                        submission.add_comment(msg)
-                    except Exception as err:
-                        # not sure what errors are possible here so
-                        # catch them all and record them, assuming they're
-                        # caused by network errors or maintenence downtime
-                        logging.error(str(err))
-                        self.sleep_multiplier += 1
-                        unlock()
-                        return
-                    self.latest.insert(submission)
-                    open(latest_file, "w").write(str(self.latest))
-                    self.alreadies.insert(submission)
-                    open(alreadies_file, "w").write(str(self.alreadies))
-                    logging.info("post: %s\nmatching: %s\nresponse: %s" % 
-                                 (submission.title, instruction.re_string, 
-                                  instruction.filename))
-                    if self.email_on:
-                        try:
-                            self.smtp.archive_comment(submission, instruction)
-                        except smtplib.SMTPException as err:
-                            logging.warning('Could not send email: %s', 
-                                            str(err))
-                    unlock()
-            self.sleep_multiplier = 1
+                    matched[submission.id] = (submission, instruction)
+        except net_cpr.Cancelled:
+            return None, None
+        for submission in batch:
+            instruction = self.wants_response(submission)
+            if instruction:
+                matched[submission.id] = (submission, instruction)
+        while pending:
+            self.collect(pending.popleft(), matched)
+        scanned.sort()
+        return scanned, matched
+
+    def collect(self, pending, matched):
+        """Adds the submissions in a (batch, result) pair matched by the 
+        pool to matched."""
+        batch, result = pending
+        for submission, number in zip(batch, self.pool.collect(result)):
+            if number is not None:
+                matched[submission.id] = (submission, 
+                                          self.instructions[number])
+
+    def respond(self, sub, scanned, matched):
+        """Posts responses to the matching submissions in a subreddit, 
+        oldest first.  Every checkpoint_every submissions, and once they've
+        all been dealt with, the latest submission for the subreddit is 
+        moved up, so an interrupted backfill can pick up where it left off.
+        When told to stop, finishes the submission in hand, saves the 
+        matching submissions still to be responded to in resume_file and
+        moves latest up past everything scanned, so nothing has to be 
+        fetched again.  Returns False if the cycle should stop."""
+        for number, (created_utc, post) in enumerate(scanned):
+            if self.should_stop():
+                self.save_resume(sub, matched)
+                created_utc, post = scanned[-1]
+                self.checkpoint(sub, post, created_utc)
+                return False
+            if post not in matched:
+                if (number + 1) % self.checkpoint_every == 0:
+                    self.checkpoint(sub, post, created_utc)
+                continue
+            submission, instruction = matched.pop(post)
+            if are_new():
+                return False
+            if not self.post_response(sub, submission, instruction):
+                return True
+        if scanned:
+            created_utc, post = scanned[-1]
+            self.checkpoint(sub, post, created_utc)
+        self.breaker(sub).success()
+        return True
+
+    def post_response(self, sub, submission, instruction):
+        """Responds to a submission and records that it's been done.  
+        Returns False if the response couldn't be posted."""
+        lock()
+        msg = self.messages[instruction.filename]
+        self.response_log.intend(subname(submission), submission.id)
+        try:
+            self.bucket.take(net_cpr.REPLY)
+            submission.add_comment(msg)
+        except Exception as err:
+            self.response_log.failed(subname(submission), submission.id)
+            # not sure what errors are possible here so
+            # catch them all and record them, assuming they're
+            # caused by network errors or maintenence downtime;
+            # not retried here, since a comment that failed 
+            # with a 5xx may have been posted anyway
+            self.breaker(sub).failure()
+            self.scheduler.postpone(sub, self.retry_delay)
+            self.metrics.count("comment_failures", 1, sub)
+            logging.error("Could not respond in %s: %s\n"
+                          "Circuit breaker %s", sub, str(err),
+                          self.breaker(sub))
+            unlock()
+            return False
+        self.record_response(submission, instruction)
+        self.metrics.count("comments", 1, sub)
+        logging.info("post: %s\nmatching: %s\nresponse: %s" % 
+                     (submission.title, instruction.re_string, 
+                      instruction.filename))
+        if self.email_on:
+            try:
+                self.smtp.archive_comment(submission, instruction)
+            except EnvironmentError as err:
+                logging.warning('Could not send email: %s', 
+                                str(err))
+        unlock()
+        return True
+
+    def save_resume(self, sub, matched):
+        """Adds the submissions in matched, which have yet to be responded
+        to, to resume_file."""
+        pending = load_resume()
+        pending.extend((sub, submission.id) for submission, instruction 
+                       in sorted(matched.values(), key = lambda pair: 
+                                 pair[0].created_utc))
+        save_resume(pending)
+        if matched:
+            logging.info("%d responses in %s left for the next run.",
+                         len(matched), sub)
+
+    def resume_pending(self):
+        """Responds to the submissions an earlier run matched but stopped
+        before responding to.  Each is fetched on its own and matched 
+        again, in case the instructions have changed.  If one can't be 
+        responded to, it and the ones after it are left for next time; one
+        that's gone for good, say deleted or in a subreddit that's since 
+        gone private, is dropped."""
+        pending = load_resume()
+        while pending and not self.should_stop():
+            sub, post = pending[0]
+            try:
+                submission = self.with_retries(
+                    lambda: self.fetch_submission(post))
+            except Exception as err:
+                if is_transient(err):
+                    logging.error("Could not fetch %s in %s: %s", post, sub,
+                                  str(err))
+                    break
+                logging.error("Could not fetch %s in %s: %s\nDropping it.",
+                              post, sub, str(err))
+                pending.pop(0)
+                save_resume(pending)
+                continue
+            instruction = self.wants_response(submission)
+            if instruction and \
+                    not self.post_response(sub, submission, instruction):
+                break
+            pending.pop(0)
+            save_resume(pending)
+
+    def fetch_submission(self, post):
+        self.bucket.take(net_cpr.FETCH)
+        return self.reddit.get_submission(submission_id = post)
+
+    def checkpoint(self, sub, post, created_utc):
+        """Records that every submission in sub up to and including post
+        has been dealt with."""
+        self.latest.advance(sub, post, created_utc)
+        self.save_state()
+
+    def breaker(self, sub):
+        """The circuit breaker for a subreddit, created when first needed."""
+        if sub not in self.breakers:
+            self.breakers[sub] = net_cpr.CircuitBreaker(
+                self.breaker_threshold, self.retry_delay, self.sleep_time)
+        return self.breakers[sub]
+
+    def next_sleep(self):
+        """How long to wait before the next subreddit is due to be polled
+        and its circuit breaker, if any, will let it through; never more 
+        than sleep_time."""
+        now = time.time()
+        wake = [max(self.scheduler.next_poll(sub), 
+                    self.breaker(sub).open_until) for sub in self.subreddits]
+        soonest = min(wake) - now if wake else self.sleep_time
+        return min(self.sleep_time, max(soonest, 1))
 
 def cpr_args():
     """Sets up the ArgumentParser; just to keep the main loop uncluttered."""
@@ -421,7 +1474,7 @@ def ensure_unique(pid_key = None):
     except OSError as err:
         if err.errno == 17:
             # file already exists
-            found_key = eval(open(pid_file, "r").read())
+            found_key = format_cpr.read_pid(pid_file)
             if found_key == pid_key:
                 open(pid_file, "w").write(str(os.getpid()))
             else:
@@ -436,14 +1489,26 @@ if __name__ == '__main__':
     ensure_unique(args.pid_key)
     signal.signal(pseudostop, sleep_handler)
     signal.signal(pseudokill, die_handler)
+    signal.signal(signal.SIGTERM, die_handler)
+    signal.signal(signal.SIGINT, die_handler)
     signal.signal(sigchange, register_change)
     cpr = CannedPostResponder(settings_file)
     cpr.connect()
+    cpr.listen()
     while True:
+        cpr.serve_commands()
+        if cpr.should_stop():
+            cpr.shutdown()
+            terminate(0)
+        if cpr.paused:
+            cpr.wait(cpr.sleep_time)
+            continue
         if are_new():
             is_change = False
-            cpr.get_set(settings_file)
-            cpr.connect()
+            cpr.reload(settings_file)
+        started = time.time()
+        cpr.resume_pending()
         cpr.forward_unread()
         cpr.match_and_respond()
-        time.sleep(cpr.sleep_time * cpr.sleep_multiplier)
+        cpr.end_cycle(started)
+        cpr.wait(cpr.next_sleep())
@@ -30,6 +30,12 @@
 
 import cannedpostresponder
 import io_cpr
+import format_cpr
+import state_cpr
+import match_cpr
+import metrics_cpr
+import socket
+import json
 import argparse
 import sys
 import re
@@ -96,6 +102,19 @@ parser.add_argument('--smtp_server', nargs = 1, type = str,
 parser.add_argument('--smtp_port', nargs = 1, type = int,
                     help = ('the port used to connect to the '
                             'SMTP server'))
+parser.add_argument('--smtp_idle', nargs = 1, type = int,
+                    help = ('how many seconds CannedPostResponder keeps an '
+                            'unused connection to the SMTP server open'))
+parser.add_argument('--outbox_batch', nargs = 1, type = int,
+                    help = ('the most emails CannedPostResponder will send '
+                            'per connection to the SMTP server'))
+parser.add_argument('--digest_interval', nargs = 1, type = int,
+                    help = ('if not 0, gather email reports into a digest '
+                            'sent at most this many seconds after the first '
+                            'report in it'))
+parser.add_argument('--digest_count', nargs = 1, type = int,
+                    help = ('the most reports that go into one digest; a '
+                            'digest is sent as soon as it has this many'))
 parser.add_argument('--proprietor', nargs = 1, type = str,
                     help = ('the Reddit account of the '
                             'person running CannedPostResponder'))
@@ -116,8 +135,105 @@ parser.add_argument('--text_editor', nargs = 1,
 parser.add_argument('--log_viewer', nargs = 1,
                     help = ('what program to use to view log file'))
 parser.add_argument('--sleep_time', nargs = 1, type = int,
-                    help = ('how CannedPostResponder should sleep before checking '
-                            'for new submissions'))
+                    help = ('the longest CannedPostResponder should sleep '
+                            'before checking a subreddit for new submissions'))
+parser.add_argument('--poll_min', nargs = 1, type = int,
+                    help = ('the shortest CannedPostResponder should sleep '
+                            'before checking a subreddit for new submissions'))
+parser.add_argument('--state_backend', nargs = 1, type = str,
+                    choices = ['text', 'sqlite'],
+                    help = ('where CannedPostResponder keeps track of the posts '
+                            'it has seen and responded to: \'text\' files or '
+                            'an \'sqlite\' database'))
+parser.add_argument('--state_batch', nargs = 1, type = int,
+                    help = ('how many responses CannedPostResponder may post '
+                            'before saving its record of them'))
+parser.add_argument('--bloom_capacity', nargs = 1, type = int,
+                    help = ('how many responses the dedupe filter in front of '
+                            'the sqlite database should be sized for; 0 turns '
+                            'the filter off'))
+parser.add_argument('--bloom_error_rate', nargs = 1, type = float,
+                    help = ('the false positive rate the dedupe filter should '
+                            'be sized for'))
+parser.add_argument('--fetch_workers', nargs = 1, type = int,
+                    help = ('how many subreddits CannedPostResponder may '
+                            'fetch at the same time'))
+parser.add_argument('--request_rate', nargs = 1, type = float,
+                    help = ('how many requests per second CannedPostResponder '
+                            'may make to Reddit, on average'))
+parser.add_argument('--request_burst', nargs = 1, type = int,
+                    help = ('how many requests CannedPostResponder may make '
+                            'in a row after being idle'))
+parser.add_argument('--retry_attempts', nargs = 1, type = int,
+                    help = ('how many times CannedPostResponder will try a '
+                            'request that fails because of a network error '
+                            'or server trouble'))
+parser.add_argument('--retry_base', nargs = 1, type = float,
+                    help = ('the longest wait in seconds before the first '
+                            'retry of a failed request; doubles for each '
+                            'retry after that'))
+parser.add_argument('--retry_cap', nargs = 1, type = float,
+                    help = ('the longest CannedPostResponder will ever wait '
+                            'before retrying a failed request'))
+parser.add_argument('--retry_delay', nargs = 1, type = int,
+                    help = ('how many seconds CannedPostResponder should sleep '
+                            'before trying again when a subreddit has failed, '
+                            'instead of sleep_time'))
+parser.add_argument('--breaker_threshold', nargs = 1, type = int,
+                    help = ('how many times in a row a subreddit may fail '
+                            'before CannedPostResponder stops trying it for '
+                            'a while'))
+parser.add_argument('--stream_window', nargs = 1, type = int,
+                    help = ('how many fetched submissions may wait to be '
+                            'matched before fetching pauses'))
+parser.add_argument('--checkpoint_every', nargs = 1, type = int,
+                    help = ('how many submissions CannedPostResponder gets '
+                            'through between saving its progress through a '
+                            'subreddit'))
+parser.add_argument('--stats_interval', nargs = 1, type = int,
+                    help = ('how often, in seconds, CannedPostResponder '
+                            'saves its statistics on each instruction'))
+parser.add_argument('--slow_match', nargs = 1, type = float,
+                    help = ('log any instruction that takes longer than '
+                            'this many seconds to check a post; 0 for never'))
+parser.add_argument('--match_timeout', nargs = 1, type = float,
+                    help = ('the longest, in seconds, an instruction may take '
+                            'to check a post before it\'s given up on; 0 for '
+                            'no limit'))
+parser.add_argument('--match_strikes', nargs = 1, type = int,
+                    help = ('how many times an instruction may run out of '
+                            'time before it\'s quarantined'))
+parser.add_argument('--match_processes', nargs = 1, type = int,
+                    help = ('how many extra processes to use for matching '
+                            'big backlogs of submissions; 0 for none'))
+parser.add_argument('--match_batch', nargs = 1, type = int,
+                    help = ('how many submissions to hand a matching process '
+                            'at a time'))
+parser.add_argument('--match_stats', action = 'store_true',
+                    help = ('show how much time each instruction has taken '
+                            'and how often it has matched, slowest first'))
+parser.add_argument('--metrics', action = 'store_true',
+                    help = ('show the running CannedPostResponder\'s '
+                            'counters and timings, or the last ones it saved '
+                            'if it isn\'t running'))
+parser.add_argument('--drain_timeout', nargs = 1, type = int,
+                    help = ('how long CannedPostResponder waits for email to '
+                            'be sent when shutting down'))
+parser.add_argument('--retention_days', nargs = 1, type = float,
+                    help = ('how many days CannedPostResponder remembers a '
+                            'response for; 0 means forever'))
+parser.add_argument('--retention_count', nargs = 1, type = int,
+                    help = ('how many of the most recent responses in each '
+                            'subreddit CannedPostResponder remembers; 0 means '
+                            'all of them'))
+parser.add_argument('--compact_interval', nargs = 1, type = int,
+                    help = ('how often, in seconds, CannedPostResponder '
+                            'applies the retention settings and compacts its '
+                            'record of responses'))
+parser.add_argument('--compact', action = 'store_true',
+                    help = ('apply the retention settings and compact the '
+                            'record of responses now, and report the space '
+                            'reclaimed'))
 parser.add_argument('--silent', action = 'store_true',
                     help = ('run cpr_admin with no visible output '
                             'unless invoked with --display or --status'))
@@ -133,14 +249,42 @@ parser.add_argument('--resume', action = 'store_true',
 parser.add_argument('--kill', action = 'store_true',
                     help = ('kill the currently running instance '
                             'of CannedPostResponder if there is one'))
+parser.add_argument('--drain', action = 'store_true',
+                    help = ('have the currently running instance of '
+                            'CannedPostResponder finish the submission in hand, '
+                            'save everything and exit'))
 parser.add_argument('--status', action = 'store_true',
                     help = ('report whether or not an instance of '
                             'CannedPostResponder is currently running'))
+parser.add_argument('--stats', action = 'store_true',
+                    help = ('show what the running CannedPostResponder has '
+                            'in memory'))
+
+def ask_bot(command):
+    """Sends a command to the running CannedPostResponder over its control
+    socket and returns the reply, or None if nothing is listening.  If the
+    command failed, says why and exits."""
+    try:
+        reply = metrics_cpr.send_command(cannedpostresponder.socket_file, 
+                                         command)
+    except socket.error:
+        return None
+    if isinstance(reply, dict) and "error" in reply:
+        print >> sys.stderr, "CannedPostResponder could not %s: %s" % \
+            (command, reply["error"])
+        sys.exit(1)
+    return reply
 
 args = parser.parse_args()
+if args.request_rate and not args.request_rate[0] > 0:
+    parser.error("--request_rate must be more than 0")
 settings = io_cpr.get_settings(cannedpostresponder.settings_file)
+for setting in cannedpostresponder.settings_defaults:
+    if setting not in settings:
+        settings[setting] = cannedpostresponder.settings_defaults[setting]
 argdic = vars(args)
-change_made = False
+# the parts of the running CannedPostResponder that need reloading
+reloads = []
 for key in argdic:
     if argdic[key]:
         adder = re.compile("add_(?P<variable>.*)")
@@ -166,7 +310,7 @@ for key in argdic:
             varname = key
             settings[varname] = argdic[key][0]
         if varname in settings:
-            change_made = True
+            reloads.append("settings")
             if not args.silent:
                 print "%s: %s" % (varname, settings[varname])
 
@@ -174,26 +318,83 @@ if args.display or len(sys.argv) == 1:
     for var in settings:
         print "%s: %s" % (var, settings[var])
 
+if args.match_stats:
+    stats = match_cpr.load_profile(cannedpostresponder.match_stats_file)
+    if stats is None:
+        print "No statistics on the instructions have been saved yet."
+    else:
+        print "Since %s, as of %s:" % (time.ctime(stats["since"]),
+                                       time.ctime(stats["saved"]))
+        print "%10s %10s %8s %10s %10s %8s  %s" % ("seconds", "searches", 
+                                                  "hits", "mean us", 
+                                                  "worst s", "length", 
+                                                  "instruction")
+        ranked = sorted(stats["instructions"], 
+                        key = lambda (instruction, record): -record[0])
+        for instruction, record in ranked:
+            seconds, searches, hits, worst, length = record
+            mean = seconds / searches * 1.0e6 if searches else 0.0
+            print "%10.3f %10d %8d %10.1f %10.4f %8d  %s" % \
+                (seconds, searches, hits, mean, worst, length, instruction)
+        never = len([instruction for instruction, record in ranked 
+                     if not record[2]])
+        print "%d of %d instructions have never matched." % (never, 
+                                                              len(ranked))
+        strikes = stats.get("strikes", {})
+        for instruction, record in ranked:
+            if instruction in strikes:
+                print "%s has run out of time %d times%s." % \
+                    (instruction, strikes[instruction], 
+                     " and is quarantined" 
+                     if instruction in stats["quarantined"] else "")
+
+if args.metrics:
+    try:
+        snapshot = metrics_cpr.send_command(cannedpostresponder.socket_file,
+                                            "metrics")
+    except socket.error:
+        snapshot = metrics_cpr.load_snapshot(cannedpostresponder.metrics_file)
+        if snapshot is not None:
+            print ("CannedPostResponder isn't answering; these are the "
+                   "figures it saved after its last pass.")
+    if snapshot is None:
+        print "No metrics have been saved yet."
+    else:
+        print "\n".join(metrics_cpr.report(snapshot))
+
 if args.instructions:
     os.system("%s %s" % (settings['text_editor'], \
                              cannedpostresponder.instructions_file))
-    change_made = True
+    reloads.append("instructions")
 
 if args.message:
     for msg_file in args.message:
         os.system("%s %s" % (settings['text_editor'], msg_file))
-    change_made = True
+    reloads.append("messages")
 
-if args.clear_latest:
+if args.clear_latest and \
+        ask_bot("clear_latest %s" % " ".join(args.clear_latest)) is not None:
+    # the running CannedPostResponder has taken care of it
+    pass
+elif args.clear_latest and settings['state_backend'] == 'sqlite':
+    db = state_cpr.StateDB(cannedpostresponder.state_db_file)
+    db.clear_latest(args.clear_latest)
+    db.close()
+elif args.clear_latest:
     if os.path.exists(cannedpostresponder.latest_file):
-        latest = eval(open(cannedpostresponder.latest_file, "r").read())
-        latest = {sub: latest[sub] for sub in latest \
-                      if sub not in args.clear_latest}
-        open(cannedpostresponder.latest_file, "w").write(str(latest))
-        change_made = True
+        latest = cannedpostresponder.Latest(cannedpostresponder.latest_file)
+        latest.clear(args.clear_latest)
+        reloads.append("latest")
 
-if args.clear_all_latest:
+if args.clear_all_latest and ask_bot("clear_latest") is not None:
+    pass
+elif args.clear_all_latest and settings['state_backend'] == 'sqlite':
+    db = state_cpr.StateDB(cannedpostresponder.state_db_file)
+    db.clear_latest()
+    db.close()
+elif args.clear_all_latest:
     os.remove(cannedpostresponder.latest_file)
+    reloads.append("latest")
 io_cpr.store_settings(cannedpostresponder.settings_file, settings)    
 
 if args.log:
@@ -202,10 +403,13 @@ if args.log:
     else:
         print "No log file currently exists"
 
-if change_made:
+# tell the running CannedPostResponder exactly what to reload, or failing
+# that signal it to look for changes itself
+if reloads and not all(ask_bot("reload %s" % component) is not None
+                       for component in sorted(set(reloads))):
     if os.path.exists(cannedpostresponder.pid_file):
         try:
-            pid = eval(open(cannedpostresponder.pid_file, "r").read())
+            pid = format_cpr.read_pid(cannedpostresponder.pid_file)
             os.kill(pid, cannedpostresponder.sigchange)
         except OSError as err:
             if err.errno == 3:
@@ -214,7 +418,7 @@ if change_made:
 if args.run:
     if os.path.exists(cannedpostresponder.pid_file):
         # clear out old pid_file if it exists
-        pid = eval(open(cannedpostresponder.pid_file, "r").read())
+        pid = format_cpr.read_pid(cannedpostresponder.pid_file)
         try:
             psutil.Process(pid)
         except Exception as err:
@@ -238,10 +442,13 @@ if args.run:
         else:
             raise err
 
-if args.suspend:
+if args.suspend and ask_bot("pause") is not None:
+    # paused between subreddits, but still answering
+    pass
+elif args.suspend:
     if os.path.exists(cannedpostresponder.pid_file):
         try:
-            pid = eval(open(cannedpostresponder.pid_file, "r").read())
+            pid = format_cpr.read_pid(cannedpostresponder.pid_file)
             os.kill(pid, cannedpostresponder.pseudostop)
         except OSError as err:
             os.remove(cannedpostresponder.pid_file)
@@ -254,10 +461,13 @@ if args.suspend:
         if not args.silent:
             print "No CannedPostResponder process running"
 
-if args.resume:
+if args.resume and ask_bot("resume") is not None:
+    pass
+elif args.resume:
+    # it may have been stopped with a signal
     if os.path.exists(cannedpostresponder.pid_file):
         try:
-            pid = eval(open(cannedpostresponder.pid_file, "r").read())
+            pid = format_cpr.read_pid(cannedpostresponder.pid_file)
             process = psutil.Process(pid)
             process.resume()
         except psutil._error.NoSuchProcess as err:
@@ -270,7 +480,7 @@ if args.resume:
 
 if args.kill:
     if os.path.exists(cannedpostresponder.pid_file):
-        pid = eval(open(cannedpostresponder.pid_file, "r").read())
+        pid = format_cpr.read_pid(cannedpostresponder.pid_file)
         try:
             process = psutil.Process(pid)
             if process.status == psutil.STATUS_STOPPED:
@@ -284,9 +494,63 @@ if args.kill:
         if not args.silent:
             print "No CannedPostResponder process running"
 
-if args.status:
+if args.drain and ask_bot("drain") is None and not args.silent:
+    print "No CannedPostResponder is answering"
+
+if args.stats:
+    stats = ask_bot("stats")
+    if stats is None:
+        print "No CannedPostResponder is answering"
+    else:
+        print json.dumps(stats, indent = 4, sort_keys = True)
+
+if args.compact:
+    report = ask_bot("compact")
+    if report is None:
+        # nothing running, so the record can be compacted right here
+        policy = state_cpr.RetentionPolicy(settings['retention_days'],
+                                           settings['retention_count'],
+                                           settings['subreddits'],
+                                           settings['limit'])
+        if settings['state_backend'] == 'sqlite':
+            db = state_cpr.StateDB(cannedpostresponder.state_db_file)
+            alreadies = cannedpostresponder.SQLiteAlreadies(db)
+            latest = cannedpostresponder.SQLiteLatest(db)
+        else:
+            db = None
+            alreadies = cannedpostresponder.Alreadies(
+                cannedpostresponder.alreadies_file)
+            latest = cannedpostresponder.Latest(
+                cannedpostresponder.latest_file)
+        report = cannedpostresponder.compact_state(
+            alreadies, latest, policy, 
+            cannedpostresponder.state_files(settings['state_backend']))
+        alreadies.close()
+        if db:
+            db.close()
+    if report.get("queued"):
+        print "CannedPostResponder will compact its record when it can"
+    else:
+        print ("Forgot %d responses and kept %d; reclaimed %d bytes "
+               "(%d to %d)" % (report["responses_removed"], 
+                               report["responses_kept"],
+                               report["bytes_reclaimed"],
+                               report["bytes_before"], report["bytes_after"]))
+        if report["subreddits_removed"]:
+            print "Forgot the subreddits %s" % \
+                ", ".join(report["subreddits_removed"])
+
+status = ask_bot("status") if args.status else None
+if status is not None:
+    state = "running"
+    if status["draining"]:
+        state = "draining"
+    elif status["paused"]:
+        state = "paused"
+    print "CannedPostResponder (pid %d) is %s" % (status["pid"], state)
+elif args.status:
     try:
-        pid = eval(open(cannedpostresponder.pid_file, "r").read())
+        pid = format_cpr.read_pid(cannedpostresponder.pid_file)
         process = psutil.Process(pid)
         print "CannedPostResponder is %s" % (str(process.status))
     except Exception as err:
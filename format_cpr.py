@@ -0,0 +1,138 @@
+#! /usr/bin/python
+# -*- coding: UTF-8
+
+###############################################################################
+# CannedPostResponder
+# by Charlie Pashayan                                                          
+# 2012                                                                         
+# format_cpr.py: The module that reads and writes CannedPostResponder's settings
+# and state files
+#                                                                              
+# Copyright (c) 2012 Charlie Pashayan                                          
+#                                                                              
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to     
+# deal in the Software without restriction, including without limitation the   
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or  
+# sell copies of the Software, and to permit persons to whom the Software is   
+# furnished to do so, subject to the following conditions:                     
+#                                                                              
+# The above copyright notice and this permission notice shall be included in   
+# all copies or substantial portions of the Software.                         
+#                                                                             
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+###############################################################################
+
+import os
+import ast
+import json
+import collections
+
+# the version of the file format written by dump(); files written by older
+# versions of CannedPostResponder, which hold a Python literal, are still read
+format_version = 1
+
+class FormatError(ValueError):
+    """Raised for a file that can't be read, such as one written by a newer
+    version of CannedPostResponder."""
+    pass
+
+def header(kind):
+    """The first line of a file of the given kind."""
+    return '{"format": %s, "version": %d}\n' % (json.dumps(kind), 
+                                                 format_version)
+
+def read_header(line, kind):
+    """Returns the version of the format given by the header line of a file
+    of the given kind, or None if line isn't a header.  A header for some 
+    other kind of file, or from a newer format, raises FormatError."""
+    if not line.startswith('{"'):
+        # the old format's dictionaries have single quoted keys
+        return None
+    found = json.loads(line)
+    if found.get("format") != kind:
+        raise FormatError("expected a %s file but found a %s file" % 
+                          (kind, found.get("format")))
+    if found.get("version", 0) > format_version:
+        raise FormatError("%s file is version %d, newer than version %d" %
+                          (kind, found["version"], format_version))
+    return found["version"]
+
+def native(value):
+    """The value read from JSON with unicode strings made into plain ones
+    wherever they'll go, as they would have been read from the old 
+    format."""
+    if isinstance(value, unicode):
+        try:
+            return value.encode("ascii")
+        except UnicodeEncodeError:
+            return value
+    if isinstance(value, list):
+        return [native(item) for item in value]
+    if isinstance(value, dict):
+        return dict((native(key), native(item)) 
+                    for key, item in value.items())
+    return value
+
+def write_atomically(filename, text):
+    """Replaces the contents of filename with text, by way of a temporary
+    file, so that a crash leaves either the old contents or the new and 
+    never a mix of the two."""
+    temp = filename + ".tmp"
+    fp = open(temp, "w")
+    fp.write(text)
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+    os.rename(temp, filename)
+
+def dump(filename, kind, records):
+    """Writes records to filename as a header line followed by one line of
+    JSON per record."""
+    write_atomically(filename, header(kind) + 
+                     "".join([json.dumps(record) + "\n" 
+                              for record in records]))
+
+def load(filename, kind, legacy = iter):
+    """Yields the records in a file written by dump(), one line at a time, 
+    so no more than one record has to be parsed before it's used.  A file 
+    in the old format is read as a Python literal, without running any 
+    code, and legacy(value) gives the records it stands for."""
+    fp = open(filename, "r")
+    try:
+        first = fp.readline()
+        if read_header(first, kind) is None:
+            try:
+                value = ast.literal_eval(first + fp.read())
+            except (SyntaxError, ValueError):
+                raise FormatError("%s is not a %s file" % (filename, kind))
+            for record in legacy(value):
+                yield record
+            return
+        for line in fp:
+            if line.strip():
+                yield native(json.loads(line))
+    finally:
+        fp.close()
+
+def dump_dict(filename, kind, dictionary):
+    """Writes a dictionary out as one [key, value] record per entry, in the
+    dictionary's own order, so the order of an OrderedDict is kept."""
+    dump(filename, kind, [[key, value] for key, value in dictionary.items()])
+
+def load_dict(filename, kind):
+    """Reads a dictionary written by dump_dict() or in the old format, as an
+    OrderedDict in the order it was written."""
+    return collections.OrderedDict(
+        (key, value) for key, value 
+        in load(filename, kind, lambda value: value.items()))
+
+def read_pid(filename):
+    """The process id in a pid file."""
+    return int(open(filename, "r").read().strip())
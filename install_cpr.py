@@ -37,7 +37,9 @@ import sys
 import imp
 import stat
 
-sourcefiles = ["cannedpostresponder.py", "io_cpr.py", "cpr_admin.py"]
+sourcefiles = ["cannedpostresponder.py", "io_cpr.py", "match_cpr.py",
+               "state_cpr.py", "net_cpr.py", "cpr_admin.py",
+               "metrics_cpr.py", "bench_cpr.py", "format_cpr.py"]
 def_name = "cpr_admin"
 
 def pull_imports(f):
@@ -35,14 +35,23 @@ import token
 import tokenize
 import readline
 import smtplib
+import socket
+import email
 from email.mime.text import MIMEText
 from datetime import datetime
 import logging
 import os
+import time
+import threading
+import itertools
+import hashlib
+import net_cpr
+import format_cpr
 
 path = os.path.dirname(os.path.abspath(__file__)) + os.sep
 
 log_file = path + ".log.txt"
+outbox_dir = path + ".outbox"
 
 class FatalError(Exception):
     pass
@@ -70,31 +79,405 @@ def dfa_barf(tok, filename, filetype):
                                                 unicode(tok[4].rstrip())))
     raise parseError
 
-class CPR_SMTP(smtplib.SMTP_SSL):
+def smtp_retriable(err):
+    """Says whether a failure to reach the mail server is worth retrying;
+    bad credentials aren't."""
+    if isinstance(err, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(err, (smtplib.SMTPException, socket.error))
+
+class SMTPConnection:
+    """A managed connection to the mail server.  It's opened when first
+    needed, checked with NOOP before being reused, reopened (with backoff)
+    if it has gone dead, and closed once it's been idle for idle seconds,
+    before the server gets around to dropping it."""
+    def __init__(self, connect, idle = 240, attempts = 3, retry_base = 1,
+                 retry_cap = 30):
+        self.connect = connect
+        self.idle = idle
+        self.attempts = attempts
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.smtp = None
+        self.last_used = 0
+
+    def get(self):
+        """Returns a live, logged in connection."""
+        if self.smtp is not None:
+            try:
+                if time.time() - self.last_used < self.idle and \
+                        self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.discard()
+        self.smtp = net_cpr.retry(self.connect, smtp_retriable, 
+                                  self.attempts, self.retry_base, 
+                                  self.retry_cap)
+        self.last_used = time.time()
+        return self.smtp
+
+    def release(self):
+        """Notes that the connection has just been used successfully."""
+        self.last_used = time.time()
+
+    def discard(self):
+        """Drops a connection that has failed, without the courtesy of a
+        QUIT."""
+        if self.smtp is not None:
+            try:
+                self.smtp.close()
+            except (smtplib.SMTPException, socket.error):
+                pass
+        self.smtp = None
+
+    def close_if_idle(self):
+        if self.smtp is not None and \
+                time.time() - self.last_used >= self.idle:
+            self.close()
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+        self.smtp = None
+
+class Digest:
+    """Collects reports in a spool of their own instead of mailing each one,
+    so that they can go out together as a single message.  A digest is due
+    once count reports have piled up or the oldest has waited interval 
+    seconds."""
+    def __init__(self, spool, interval, count):
+        self.spool = spool
+        self.interval = interval
+        self.count = count
+        self.serial = itertools.count()
+        if not os.path.isdir(spool):
+            os.makedirs(spool)
+
+    def add(self, subject, message):
+        """Spools one report."""
+        name = "%017.6f-%d-%d.evt" % (time.time(), os.getpid(), 
+                                      next(self.serial))
+        temp = os.path.join(self.spool, name + ".tmp")
+        fp = open(temp, "w")
+        fp.write(subject.encode("UTF-8") + "\n" + message.encode("UTF-8"))
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.rename(temp, os.path.join(self.spool, name))
+
+    def pending(self):
+        return sorted(name for name in os.listdir(self.spool) 
+                      if name.endswith(".evt"))
+
+    def due(self):
+        pending = self.pending()
+        if not pending:
+            return False
+        oldest = float(pending[0].split("-")[0])
+        return len(pending) >= self.count or \
+            time.time() - oldest >= self.interval
+
+    def collect(self):
+        """Returns (subject, message, names) for a digest of up to count
+        spooled reports.  The reports stay in the spool until discard() is
+        called with their names."""
+        names = self.pending()[:self.count]
+        sections = []
+        for name in names:
+            text = open(os.path.join(self.spool, name), "r").read()
+            subject, body = text.decode("UTF-8").split("\n", 1)
+            sections.append("=== %s ===\n%s" % (subject, body))
+        subject = "[digest] %d reports, %s" % (len(names), 
+                                               str(datetime.now()))
+        return subject, "\n\n".join(sections), names
+
+    def discard(self, names):
+        for name in names:
+            os.remove(os.path.join(self.spool, name))
+
+# the spools whose claimed messages have been put back since this process
+# started; see recover_claims()
+recovered_spools = set()
+
+def recover_claims(spool):
+    """Puts messages claimed by a worker that died before finishing back in
+    the spool.  Only done the first time a spool is opened by a process: 
+    after that, a claimed message may belong to an earlier Outbox's worker
+    that is still sending it."""
+    if spool in recovered_spools:
+        return
+    recovered_spools.add(spool)
+    for name in os.listdir(spool):
+        if name.endswith(".sending"):
+            os.rename(os.path.join(spool, name), 
+                      os.path.join(spool, name[:-len(".sending")]))
+
+def smtp_permanent(err):
+    """Says whether a failure to send a message means it will never be 
+    accepted, so there's no point trying it again."""
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(err, smtplib.SMTPDataError) and \
+        500 <= err.smtp_code < 600
+
+class Outbox:
+    """A durable spool of outgoing mail, with a background thread that 
+    delivers it.  Each message is written to its own file in the spool 
+    directory before put() returns, so nothing is lost if the process dies
+    or the server is down; the worker sends up to batch messages at a time
+    over a shared SMTPConnection and backs off when sending fails.  A 
+    message is claimed by renaming it before it's sent, so two workers 
+    sharing a spool can't send the same message twice.  A message the 
+    server refuses for good is moved to the failed directory in the spool 
+    rather than holding up the ones behind it.  How long each message 
+    takes to send is added to metrics if given."""
+    def __init__(self, spool, connection, batch = 20, retry_base = 30, 
+                 retry_cap = 3600, digest = None, compose = None, 
+                 metrics = None):
+        self.spool = spool
+        self.metrics = metrics
+        self.connection = connection
+        self.digest = digest
+        self.compose = compose
+        self.batch = batch
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.failures = 0
+        self.retry_at = 0
+        self.stopping = False
+        # set while the worker is sending, when its message isn't pending
+        self.busy = False
+        self.wake = threading.Event()
+        self.count = itertools.count()
+        self.thread = None
+        self.failed = os.path.join(spool, "failed")
+        if not os.path.isdir(self.failed):
+            os.makedirs(self.failed)
+        recover_claims(spool)
+
+    def put(self, msg):
+        """Spools a message, given as an email.message.Message, and lets
+        the worker know it's there."""
+        name = "%017.6f-%d-%d.eml" % (time.time(), os.getpid(), 
+                                      next(self.count))
+        temp = os.path.join(self.spool, name + ".tmp")
+        fp = open(temp, "w")
+        fp.write(msg.as_string())
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.rename(temp, os.path.join(self.spool, name))
+        self.wake.set()
+
+    def pending(self):
+        return sorted(name for name in os.listdir(self.spool) 
+                      if name.endswith(".eml"))
+
+    def flush(self, timeout):
+        """Waits up to timeout seconds for the worker to send what's in 
+        the spool.  Whatever's left is sent by the next run."""
+        deadline = time.time() + timeout
+        self.wake.set()
+        while (self.pending() or self.busy) and time.time() < deadline and \
+                self.thread and self.thread.is_alive():
+            time.sleep(0.1)
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout = 10):
+        """Stops the worker, giving it up to timeout seconds to finish what
+        it's sending."""
+        self.stopping = True
+        self.wake.set()
+        if self.thread:
+            self.thread.join(timeout)
+        if not self.thread or not self.thread.is_alive():
+            self.connection.close()
+
+    def run(self):
+        while not self.stopping:
+            delay = self.retry_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            # files may be left by an earlier run, so look now and then
+            # even if nothing new has been put
+            self.wake.wait(min(60, self.connection.idle))
+            self.wake.clear()
+            if self.stopping:
+                break
+            self.busy = True
+            try:
+                self.spool_digests()
+                self.send_pending()
+                self.connection.close_if_idle()
+            except Exception:
+                # keep the worker alive; whatever failed is tried again
+                # after a backoff
+                logging.exception("Outbox worker failed")
+                self.connection.discard()
+                self.failures += 1
+                self.retry_at = time.time() + \
+                    net_cpr.backoff(self.failures, self.retry_base, 
+                                    self.retry_cap)
+            finally:
+                self.busy = False
+
+    def spool_digests(self):
+        """Turns reports waiting in the digest, if there is one, into 
+        messages in the outbox once they're due."""
+        while self.digest and self.digest.due():
+            subject, message, names = self.digest.collect()
+            self.put(self.compose(subject, message))
+            self.digest.discard(names)
+
+    def send_pending(self):
+        """Sends everything in the spool, a batch per SMTP session.  On 
+        failure, leaves the rest for a later retry."""
+        while self.pending():
+            try:
+                self.send_batch(self.pending()[:self.batch])
+            except (smtplib.SMTPException, socket.error) as err:
+                self.failures += 1
+                if self.metrics is not None:
+                    self.metrics.count("smtp_failures")
+                delay = net_cpr.backoff(self.failures, self.retry_base, 
+                                        self.retry_cap)
+                self.retry_at = time.time() + delay
+                logging.warning("Could not send email: %s\n"
+                                "%d messages waiting; retrying in %ds", 
+                                str(err), len(self.pending()), delay)
+                return
+            self.failures = 0
+
+    def send_batch(self, names):
+        smtp = self.connection.get()
+        for name in names:
+            filename = os.path.join(self.spool, name)
+            claimed = filename + ".sending"
+            try:
+                os.rename(filename, claimed)
+            except OSError:
+                # another worker got to it first
+                continue
+            try:
+                text = open(claimed, "r").read()
+                msg = email.message_from_string(text)
+                recipients = [to.strip() for to in 
+                              (msg['To'] or "").split(",") if to.strip()]
+                if not recipients:
+                    raise smtplib.SMTPRecipientsRefused({})
+                start = time.time()
+                smtp.sendmail(msg['From'], recipients, text)
+                if self.metrics is not None:
+                    self.metrics.observe("smtp_seconds", time.time() - start)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                os.rename(claimed, filename)
+                self.connection.discard()
+                raise
+            except smtplib.SMTPException as err:
+                if not smtp_permanent(err):
+                    os.rename(claimed, filename)
+                    raise
+                self.reject(claimed, name, err)
+                continue
+            except:
+                os.rename(claimed, filename)
+                raise
+            try:
+                os.remove(claimed)
+            except OSError:
+                # sent, but the claim has gone missing; nothing to undo
+                logging.warning("Sent %s but its claim was already gone", 
+                                name)
+            self.connection.release()
+
+    def reject(self, claimed, name, err):
+        """Moves a claimed message the server will never accept into the
+        failed directory, where it's kept for a human to look at."""
+        os.rename(claimed, os.path.join(self.failed, name))
+        if self.metrics is not None:
+            self.metrics.count("smtp_rejected")
+        if isinstance(err, smtplib.SMTPRecipientsRefused) and \
+                not err.recipients:
+            err = "it has no recipients"
+        logging.error("Email %s was refused and moved to %s: %s", name,
+                      self.failed, str(err))
+
+class CPR_SMTP:
     """This class returns an smtp object specifically designed for
-    passing along messages from CannedPostResponder."""
-    def __init__(self, host, port = 465):
-        """Creates an SMTP_SSL object for handling mail."""
-        self.smtp = smtplib.SMTP_SSL(host = host, port = port)
+    passing along messages from CannedPostResponder.  Messages go through
+    an Outbox, so sending one never waits on the mail server.  With a 
+    digest_interval, reports are gathered into a Digest and mailed together
+    every digest_interval seconds or digest_count reports."""
+    def __init__(self, host, port = 465, spool = outbox_dir, batch = 20,
+                 digest_interval = 0, digest_count = 50, idle = 240,
+                 metrics = None):
+        """Sets up the outbox; nothing is sent until start() is called."""
+        self.host = host
+        self.port = port
+        self.connection = SMTPConnection(self.connect, idle)
+        self.digest = None
+        if digest_interval:
+            self.digest = Digest(os.path.join(spool, "digest"), 
+                                 digest_interval, digest_count)
+        self.outbox = Outbox(spool, self.connection, batch, 
+                             digest = self.digest, compose = self.compose,
+                             metrics = metrics)
+
+    def connect(self):
+        """Opens a new SMTP_SSL connection and logs in."""
+        smtp = smtplib.SMTP_SSL(host = self.host, port = self.port)
+        smtp.login(self.sender, self.password)
+        return smtp
 
     def login(self, user, password):
-        """Logs in to the specified address."""
+        """Logs in to the specified address, to make sure it can be done.
+        The connection is left open for the outbox, which will close it if
+        it goes unused."""
         self.sender = user
-        return self.smtp.login(user, password)        
+        self.password = password
+        self.connection.get()
+        self.connection.release()
 
     def set_recipients(self, recipients):
         """Set recipients for mail for this session."""
         self.recipients = recipients
 
-    def send_email(self, subject, message):
-        """Sends specified message with specified subject to specified
-        recipients.  Uses the email address that was previously specified."""
+    def start(self):
+        self.outbox.start()
+
+    def flush(self, timeout):
+        self.outbox.flush(timeout)
+
+    def close(self):
+        self.outbox.stop()
+
+    def compose(self, subject, message):
+        """Makes a message with specified subject for specified recipients,
+        from the email address that was previously specified."""
         message = message.encode("UTF-8")
         msg = MIMEText(message)
         msg['Subject'] = subject
         msg['From'] = self.sender
         msg['To'] = ", ".join(self.recipients)
-        self.smtp.sendmail(self.sender, self.recipients, msg.as_string())
+        return msg
+
+    def send_email(self, subject, message):
+        """Queues specified message with specified subject, or adds it to
+        the digest if there is one."""
+        if self.digest:
+            self.digest.add(subject, message)
+            if len(self.digest.pending()) >= self.digest.count:
+                self.outbox.wake.set()
+        else:
+            self.outbox.put(self.compose(subject, message))
 
     def archive_comment(self, submission, instruction):
         """Archives the fact that CannedPostResponder has responded to a 
@@ -134,31 +517,46 @@ class CPR_SMTP(smtplib.SMTP_SSL):
                                            msg.body)
         return self.send_email(subject, message)
 
+def signature(filename):
+    """A hash of a file's contents, or None if it doesn't exist; used to 
+    tell which files have changed."""
+    try:
+        return hashlib.md5(open(filename, "rb").read()).hexdigest()
+    except IOError:
+        return None
+
 def get_settings(settings):
     """Reads the CannedPostResponder settings file (setting.txt) and converts
-    its contents into a dictionary."""
+    its contents into a dictionary, which keeps the settings in the order
+    they're in the file."""
     try:
-        fp = open(settings, "r")
-    except:
-        logging.error("Settings file %s nonexistent or unreadable." % 
-                      (settings))
-        raise FatalError.fileError
-    settings = eval(fp.read())
-    return settings
+        return format_cpr.load_dict(settings, "settings")
+    except (IOError, ValueError) as err:
+        # FormatError is a ValueError, as is a line of bad JSON
+        logging.error("Settings file %s nonexistent or unreadable: %s" % 
+                      (settings, str(err)))
+        raise fileError()
 
 def store_settings(settings_file, settings):
     """Stores the CannedPostResponder settings to the settings file."""
-    fp = open(settings_file, "w")
-    fp.write(str(settings))
+    format_cpr.dump_dict(settings_file, "settings", settings)
 
 class Instruction_Parser:
-    def __init__(self, instructions):
+    def __init__(self, instructions, fp = None):
+        """Parses the named instructions file, or the open file fp if one
+        is given (in which case instructions is only used in messages).
+        After each instruction is returned, span holds the first and last
+        line numbers it was found on."""
         self.instructions = instructions
-        try:
-            self.fp = open(instructions, "r")
-        except:
-            logging.error("Instructions file %s unreadable or nonexistent" % 
-                          (instructions))
+        self.span = None
+        if fp is not None:
+            self.fp = fp
+        else:
+            try:
+                self.fp = open(instructions, "r")
+            except:
+                logging.error("Instructions file %s unreadable or nonexistent" % 
+                              (instructions))
         self.unescaped_qm = re.compile("(?<!\\\\)'")
         self.tok_stream = tokenize.generate_tokens(self.fp.readline)
 
@@ -183,6 +581,7 @@ class Instruction_Parser:
                 # and a lot of typing below
                 continue
             if state == "begin":
+                first_line = tok[2][0]
                 if tok[0] == token.STRING:
                     regex = tok[1]
                     can_comma = True
@@ -275,6 +674,7 @@ class Instruction_Parser:
                     dfa_barf(tok, self.instructions, "instructions")
             elif state == "newline":
                 if tok[0] == token.NEWLINE:
+                    self.span = (first_line, tok[2][0])
                     state = "return"
                 else:
                     dfa_barf(tok, self.instructions, "instructions")
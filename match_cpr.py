@@ -0,0 +1,565 @@
+#! /usr/bin/python
+# -*- coding: UTF-8
+
+###############################################################################
+# CannedPostResponder
+# by Charlie Pashayan                                                          
+# 2012                                                                         
+# match_cpr.py: The module that compiles CannedPostResponder's instructions
+# into a form that can be matched against submissions quickly
+#                                                                              
+# Copyright (c) 2012 Charlie Pashayan                                          
+#                                                                              
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to     
+# deal in the Software without restriction, including without limitation the   
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or  
+# sell copies of the Software, and to permit persons to whom the Software is   
+# furnished to do so, subject to the following conditions:                     
+#                                                                              
+# The above copyright notice and this permission notice shall be included in   
+# all copies or substantial portions of the Software.                         
+#                                                                             
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+###############################################################################
+
+import re
+import os
+import sre_parse
+import sre_constants
+import tokenize
+import hashlib
+import marshal
+import StringIO
+import time
+import logging
+import signal
+import multiprocessing
+import io_cpr
+import format_cpr
+
+# bump whenever what's stored in the instruction cache changes
+cache_version = 1
+
+# literals shorter than this are too common to be worth indexing
+min_keyword = 2
+
+def required_literals(pattern):
+    """Finds the runs of literal text that every match of a compiled pattern
+    has to contain, e.g. "gr" and "ning" for gr(ee|oa)ning.  Returns a 
+    (literals, fold) tuple, where fold says whether the literals have been 
+    lowercased for an IGNORECASE pattern.  The list of literals is empty
+    when nothing useful could be found."""
+    if pattern.flags & re.LOCALE:
+        # can't know what the locale will consider equal
+        return [], False
+    fold = bool(pattern.flags & re.IGNORECASE)
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except sre_constants.error:
+        return [], False
+    runs = []
+    collect_runs(parsed, runs)
+    literals = []
+    for run in runs:
+        if fold:
+            run = run.lower()
+        if len(run) >= min_keyword and run not in literals:
+            literals.append(run)
+    return literals, fold
+
+def collect_runs(parsed, runs):
+    """Walks a parsed regex, appending to runs each stretch of consecutive
+    literals that can't be skipped by a match.  Alternations, optional
+    pieces and character classes break up runs and contribute nothing."""
+    chars = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            chars.append(unichr(av))
+            continue
+        if chars:
+            runs.append(u"".join(chars))
+            chars = []
+        if op == sre_constants.SUBPATTERN:
+            # group contents are always the last item
+            collect_runs(av[-1], runs)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) \
+                and av[0] >= 1:
+            collect_runs(av[2], runs)
+    if chars:
+        runs.append(u"".join(chars))
+
+class InstructionSet:
+    """The instructions for CannedPostResponder, compiled for matching.
+    A post only gets run through the regexes whose required literal text
+    it contains (plus the ones nothing could be extracted from).  Each 
+    literal is looked for with the in operator, longest first, since the
+    longest is the least likely to be there.  Instructions are still 
+    tried in the order they appear in the instructions file."""
+    def __init__(self, instructions, known = None, slow = 0):
+        """known may map the re_strings of instructions to their 
+        required_literals(), to save working them out again.  A search 
+        taking longer than slow seconds is logged, unless slow is 0."""
+        self.instructions = list(instructions)
+        self.slow = slow
+        # str(instruction) -> [seconds, evaluations, hits, worst seconds,
+        # length of the worst input]
+        self.profile = {}
+        self.records = [self.profile.setdefault(str(instruction), 
+                                                [0.0, 0, 0, 0.0, 0])
+                        for instruction in self.instructions]
+        self.since = time.time()
+        # str(instruction) -> how many times it has run out of time
+        self.strikes = {}
+        self.max_strikes = 0
+        self.quarantined = set()
+        self.guard = None
+        # (whether to look in the lowercased post, literals longest first)
+        self.requirements = []
+        self.literals = {}
+        for instruction in self.instructions:
+            if known and instruction.re_string in known:
+                literals, fold = known[instruction.re_string]
+            else:
+                literals, fold = required_literals(instruction.re_compiled)
+            self.literals[instruction.re_string] = (literals, fold)
+            self.requirements.append((fold, sorted(literals, key = len, 
+                                                   reverse = True)))
+        self.reset_stats()
+
+    def __iter__(self):
+        return iter(self.instructions)
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __getitem__(self, number):
+        return self.instructions[number]
+
+    def reset_stats(self):
+        """Zeroes the counts of regexes evaluated and skipped."""
+        self.evaluated = 0
+        self.skipped = 0
+
+    def adopt_profile(self, profile, since, strikes = {}):
+        """Carries over the profile and strikes of the instructions that 
+        haven't changed from an earlier InstructionSet or the stats file."""
+        for key in self.profile:
+            if key in profile:
+                self.profile[key][:] = profile[key]
+            if key in strikes:
+                self.strikes[key] = strikes[key]
+        self.since = min(self.since, since)
+        self.requarantine()
+
+    def set_guard(self, timeout, strikes):
+        """With a timeout, regexes are searched in a worker process and any
+        search taking longer than timeout seconds is abandoned; once an 
+        instruction has run out of time strikes times it's quarantined, 
+        and not tried again until it's changed.  A timeout of 0 searches 
+        in this process with no time limit."""
+        self.close()
+        self.max_strikes = strikes
+        if timeout:
+            self.guard = RegexGuard([(instruction.re_compiled.pattern, 
+                                      instruction.re_compiled.flags) 
+                                     for instruction in self.instructions], 
+                                    timeout)
+        self.requarantine()
+
+    def requarantine(self):
+        self.quarantined = set(
+            number for number, instruction in enumerate(self.instructions)
+            if self.max_strikes and 
+            self.strikes.get(str(instruction), 0) >= self.max_strikes)
+
+    def close(self):
+        """Stops the guard's worker process, if there is one."""
+        if self.guard is not None:
+            self.guard.stop()
+            self.guard = None
+
+    def match(self, haystack):
+        """Returns the first instruction whose regex matches haystack,
+        or None if there isn't one."""
+        number = self.first(haystack)
+        return None if number is None else self.instructions[number]
+
+    def first(self, haystack):
+        """Returns the number of the first instruction whose regex matches
+        haystack, or None if there isn't one."""
+        candidates = self.candidates(haystack)
+        if self.guard is not None:
+            return self.guarded_match(haystack, list(candidates))
+        for number in candidates:
+            self.evaluated += 1
+            start = time.time()
+            hit = self.instructions[number].re_compiled.search(haystack)
+            self.note(number, time.time() - start, haystack)
+            if hit:
+                self.records[number][2] += 1
+                return number
+        return None
+
+    def candidates(self, haystack):
+        """Generates the numbers of the instructions, in order, whose 
+        literals all appear in haystack, leaving out quarantined ones.  
+        Since first() stops at the first match, instructions after it are
+        never looked at."""
+        lowered = None
+        for number, (fold, needed) in enumerate(self.requirements):
+            if number in self.quarantined:
+                continue
+            if needed:
+                if fold:
+                    if lowered is None:
+                        lowered = haystack.lower()
+                    text = lowered
+                else:
+                    text = haystack
+                for literal in needed:
+                    if literal not in text:
+                        self.skipped += 1
+                        break
+                else:
+                    yield number
+                continue
+            yield number
+
+    def guarded_match(self, haystack, candidates):
+        """first(), with the searching done by the guard."""
+        if not candidates:
+            return None
+        hit, timings, timeouts = self.guard.search(haystack, candidates)
+        self.evaluated += len(timings) + len(timeouts)
+        for number, elapsed in timings:
+            self.note(number, elapsed, haystack)
+        for number in timeouts:
+            self.strike(number, haystack)
+        if hit is not None:
+            self.records[hit][2] += 1
+        return hit
+
+    def merge(self, records, evaluated, skipped):
+        """Adds in the profile and counts from a copy of this InstructionSet
+        in another process."""
+        seen = set()
+        for mine, theirs in zip(self.records, records):
+            # identical instructions share a record
+            if id(mine) in seen:
+                continue
+            seen.add(id(mine))
+            mine[0] += theirs[0]
+            mine[1] += theirs[1]
+            mine[2] += theirs[2]
+            if theirs[3] > mine[3]:
+                mine[3:] = theirs[3:]
+        self.evaluated += evaluated
+        self.skipped += skipped
+
+    def note(self, number, elapsed, haystack):
+        """Adds a search to the profile."""
+        record = self.records[number]
+        record[0] += elapsed
+        record[1] += 1
+        if elapsed > record[3]:
+            record[3] = elapsed
+            record[4] = len(haystack)
+        if self.slow and elapsed > self.slow:
+            logging.warning("%s took %.2f seconds to search %d "
+                            "characters:\n%s", self.instructions[number], 
+                            elapsed, len(haystack), haystack[:200])
+
+    def strike(self, number, haystack):
+        """Records that an instruction ran out of time, quarantining it if
+        that's happened too often."""
+        instruction = self.instructions[number]
+        key = str(instruction)
+        self.strikes[key] = self.strikes.get(key, 0) + 1
+        record = self.records[number]
+        record[0] += self.guard.timeout
+        record[1] += 1
+        record[3] = max(record[3], self.guard.timeout)
+        record[4] = max(record[4], len(haystack))
+        logging.warning("%s ran out of time after %.2f seconds searching %d "
+                        "characters:\n%s", instruction, self.guard.timeout, 
+                        len(haystack), haystack[:200])
+        if self.max_strikes and self.strikes[key] >= self.max_strikes:
+            self.quarantined.add(number)
+            logging.error("%s has run out of time %d times and is "
+                          "quarantined.  It won't be tried again until it's "
+                          "changed in the instructions file.", instruction,
+                          self.strikes[key])
+
+    def save_profile(self, filename):
+        """Writes the profile out for cpr_admin.py --match_stats, with the
+        instructions in the order they're tried."""
+        stats = {"since": self.since, "saved": time.time(),
+                 "instructions": [(str(instruction), record) 
+                                  for instruction, record 
+                                  in zip(self.instructions, self.records)],
+                 "strikes": self.strikes, 
+                 "quarantined": [str(self.instructions[number]) 
+                                 for number in sorted(self.quarantined)]}
+        format_cpr.dump_dict(filename, "match_stats", stats)
+
+def load_profile(filename):
+    """Reads a profile written by save_profile(), returning None if there
+    isn't one."""
+    try:
+        return dict(format_cpr.load_dict(filename, "match_stats"))
+    except (IOError, format_cpr.FormatError):
+        return None
+
+def reset_signals():
+    """Gives a worker process back the default handlers for the signals the
+    main process handles itself, so that terminate() really ends it rather 
+    than just asking it to drain."""
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, 
+                   signal.SIGUSR2, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_DFL)
+
+def guarded_search(patterns, conn, current):
+    """The body of a RegexGuard's worker process.  Takes (haystack, 
+    numbers) requests from conn and tries the numbered patterns against
+    haystack in turn, until one matches.  Replies with the number of the
+    one that matched, or None, and (number, seconds) for each search.  The 
+    number of the pattern being searched and when the search started are 
+    kept in current, for the guard to keep an eye on."""
+    reset_signals()
+    compiled = [re.compile(pattern, flags) for pattern, flags in patterns]
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        haystack, numbers = request
+        hit = None
+        timings = []
+        for number in numbers:
+            # the start time goes first, so the guard never sees a new
+            # pattern with an old start time
+            current[1] = time.time()
+            current[0] = number
+            found = compiled[number].search(haystack)
+            timings.append((number, time.time() - current[1]))
+            if found:
+                hit = number
+                break
+        current[0] = -1
+        conn.send((hit, timings))
+
+class RegexGuard:
+    """Searches with a set of regexes in a worker process, so that a 
+    search that's taking too long can be abandoned by killing the worker,
+    since a search can't be interrupted any other way.  A new worker is 
+    started to carry on with the regexes after the one that ran out of 
+    time."""
+    def __init__(self, patterns, timeout):
+        self.patterns = patterns
+        self.timeout = timeout
+        self.worker = None
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.current = multiprocessing.RawArray("d", [-1, 0])
+        self.worker = multiprocessing.Process(target = guarded_search, 
+                                              args = (self.patterns, child,
+                                                      self.current))
+        self.worker.daemon = True
+        self.worker.start()
+        child.close()
+
+    def stop(self):
+        if self.worker is None:
+            return
+        try:
+            self.conn.send(None)
+        except EnvironmentError:
+            pass
+        self.worker.join(self.timeout)
+        self.kill()
+
+    def kill(self):
+        if self.worker.is_alive():
+            self.worker.terminate()
+        self.worker.join()
+        self.conn.close()
+        self.worker = None
+
+    def search(self, haystack, numbers):
+        """Tries the numbered regexes against haystack in order, until 
+        one matches.  Returns the number of the one that matched or None,
+        (number, seconds) for each search that finished, and the numbers
+        of the regexes that ran out of time."""
+        timings = []
+        timeouts = []
+        while numbers:
+            if self.worker is None:
+                self.start()
+            self.conn.send((haystack, numbers))
+            while True:
+                try:
+                    if self.conn.poll(self.timeout):
+                        hit, done = self.conn.recv()
+                        timings.extend(done)
+                        return hit, timings, timeouts
+                except EOFError:
+                    # the worker died in the middle of a search
+                    number = int(self.current[0])
+                    break
+                number = int(self.current[0])
+                if number >= 0 and time.time() - self.current[1] > \
+                        self.timeout:
+                    break
+            self.kill()
+            if number < 0:
+                raise RuntimeError("regex worker process died")
+            timeouts.append(number)
+            numbers = numbers[numbers.index(number) + 1:]
+        return None, timings, timeouts
+
+# the InstructionSet in a MatchPool worker process
+pool_set = None
+
+def pool_init(instructions, literals, slow, quarantined):
+    global pool_set
+    reset_signals()
+    pool_set = InstructionSet(instructions, literals, slow)
+    pool_set.quarantined = quarantined
+
+def pool_match(haystacks):
+    """Matches a batch of haystacks in a MatchPool worker process.  Returns
+    the number of the first matching instruction for each, and the profile
+    and counts run up doing it."""
+    hits = [pool_set.first(haystack) for haystack in haystacks]
+    records = [record[:] for record in pool_set.records]
+    for record in pool_set.records:
+        record[:] = [0.0, 0, 0, 0.0, 0]
+    evaluated, skipped = pool_set.evaluated, pool_set.skipped
+    pool_set.reset_stats()
+    return hits, records, evaluated, skipped
+
+class MatchPool:
+    """A pool of worker processes, each holding a copy of an InstructionSet,
+    for matching big batches of posts on more than one core.  Profiles and
+    counts from the workers are added to the original InstructionSet as 
+    their results are collected."""
+    def __init__(self, instructions, processes):
+        self.instructions = instructions
+        self.pool = multiprocessing.Pool(processes, pool_init, 
+                                         (instructions.instructions, 
+                                          instructions.literals,
+                                          instructions.slow,
+                                          instructions.quarantined))
+
+    def submit(self, haystacks):
+        """Starts matching a batch of haystacks, returning an AsyncResult
+        to hand to collect()."""
+        return self.pool.apply_async(pool_match, (haystacks,))
+
+    def collect(self, result):
+        """Waits for a batch submitted earlier, returning the number of the
+        first matching instruction, or None, for each of its haystacks."""
+        hits, records, evaluated, skipped = result.get()
+        self.instructions.merge(records, evaluated, skipped)
+        return hits
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+class InstructionCache:
+    """Saves the work of parsing the instructions file between runs.  The
+    cache holds the (regex, flags, filename) of every instruction, with the
+    lines of the file it came from, and the required literals of every 
+    regex.  If the file hasn't changed at all, its instructions come 
+    straight out of the cache.  If it has, the instructions whose lines are
+    unchanged are reused and only the lines in between are parsed; if 
+    that fails for any reason, the whole file is parsed from scratch."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.digest = None
+        self.chunks = []
+        self.literals = {}
+        try:
+            fp = open(filename, "rb")
+            cached = marshal.load(fp)
+            fp.close()
+            if cached[0] == cache_version:
+                version, self.digest, self.chunks, self.literals = cached
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+
+    def parse(self, instructions):
+        """Returns the (regex, flags, filename) triples in the named 
+        instructions file."""
+        text = open(instructions, "r").read()
+        digest = hashlib.md5(text).hexdigest()
+        if digest != self.digest:
+            try:
+                self.chunks = self.reparse(text, instructions)
+            except (io_cpr.parseError, tokenize.TokenError, SyntaxError):
+                lines = text.splitlines(True)
+                self.chunks = self.parse_lines(lines, instructions)
+            self.digest = digest
+        return [rule for chunk, rule in self.chunks]
+
+    def reparse(self, text, instructions):
+        """Reuses cached instructions whose lines appear unchanged in text,
+        parsing whatever lies between them."""
+        starts = {}
+        for chunk in self.chunks:
+            first = chunk[0][:chunk[0].index("\n") + 1]
+            starts.setdefault(first, []).append(chunk)
+        lines = text.splitlines(True)
+        chunks = []
+        dirty = []
+        number = 0
+        while number < len(lines):
+            for chunk in starts.get(lines[number], []):
+                length = chunk[0].count("\n")
+                if "".join(lines[number:number + length]) == chunk[0]:
+                    chunks.extend(self.parse_lines(dirty, instructions))
+                    dirty = []
+                    chunks.append(chunk)
+                    number += length
+                    break
+            else:
+                dirty.append(lines[number])
+                number += 1
+        chunks.extend(self.parse_lines(dirty, instructions))
+        return chunks
+
+    def parse_lines(self, lines, instructions):
+        """Parses a run of lines from the instructions file, returning a 
+        (text, instruction) pair for each instruction found."""
+        if not lines:
+            return []
+        if not lines[-1].endswith("\n"):
+            lines = lines[:-1] + [lines[-1] + "\n"]
+        ip = io_cpr.Instruction_Parser(instructions, 
+                                       StringIO.StringIO("".join(lines)))
+        chunks = []
+        for rule in ip:
+            first, last = ip.span
+            chunks.append(("".join(lines[first - 1:last]), rule))
+        return chunks
+
+    def save(self, literals):
+        """Writes the cache out, along with the required literals of each 
+        regex."""
+        self.literals = literals
+        temp = self.filename + ".tmp"
+        fp = open(temp, "wb")
+        marshal.dump((cache_version, self.digest, self.chunks, literals), fp)
+        fp.close()
+        os.rename(temp, self.filename)
@@ -0,0 +1,194 @@
+#! /usr/bin/python
+# -*- coding: UTF-8
+
+###############################################################################
+# CannedPostResponder
+# by Charlie Pashayan                                                          
+# 2012                                                                         
+# metrics_cpr.py: The module that keeps count of what CannedPostResponder
+# is doing, and the socket cpr_admin.py uses to talk to it
+#                                                                              
+# Copyright (c) 2012 Charlie Pashayan                                          
+#                                                                              
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to     
+# deal in the Software without restriction, including without limitation the   
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or  
+# sell copies of the Software, and to permit persons to whom the Software is   
+# furnished to do so, subject to the following conditions:                     
+#                                                                              
+# The above copyright notice and this permission notice shall be included in   
+# all copies or substantial portions of the Software.                         
+#                                                                             
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+###############################################################################
+
+import os
+import time
+import json
+import copy
+import socket
+import logging
+import threading
+import SocketServer
+
+# upper bounds, in seconds, of the buckets timings are sorted into; the 
+# last bucket takes everything longer
+buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+class Metrics:
+    """Counters, gauges and histograms describing the running 
+    CannedPostResponder, safe to update from any thread.  Each figure may 
+    be broken down by a label, such as the name of a subreddit; "" is the
+    label for figures that aren't."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, amount = 1, label = ""):
+        with self.lock:
+            labels = self.counters.setdefault(name, {})
+            labels[label] = labels.get(label, 0) + amount
+
+    def gauge(self, name, value, label = ""):
+        with self.lock:
+            self.gauges.setdefault(name, {})[label] = value
+
+    def observe(self, name, seconds, label = ""):
+        """Adds a timing to a histogram."""
+        with self.lock:
+            labels = self.histograms.setdefault(name, {})
+            if label not in labels:
+                labels[label] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                 "buckets": [0] * (len(buckets) + 1)}
+            histogram = labels[label]
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            bucket = 0
+            while bucket < len(buckets) and seconds > buckets[bucket]:
+                bucket += 1
+            histogram["buckets"][bucket] += 1
+
+    def snapshot(self):
+        """All the figures, as a dictionary that can be turned into 
+        JSON."""
+        with self.lock:
+            return {"pid": os.getpid(), "started": self.started, 
+                    "time": time.time(), "buckets": buckets,
+                    "counters": copy.deepcopy(self.counters),
+                    "gauges": copy.deepcopy(self.gauges),
+                    "histograms": copy.deepcopy(self.histograms)}
+
+    def save(self, filename):
+        """Writes a snapshot to filename, for when nobody's listening on
+        the socket."""
+        temp = filename + ".tmp"
+        fp = open(temp, "w")
+        json.dump(self.snapshot(), fp)
+        fp.close()
+        os.rename(temp, filename)
+
+def load_snapshot(filename):
+    """Reads a snapshot saved by Metrics.save(), or returns None."""
+    try:
+        return json.load(open(filename, "r"))
+    except (IOError, ValueError):
+        return None
+
+def quantile(histogram, fraction):
+    """Estimates a quantile of a histogram as the upper bound of the 
+    bucket it falls in."""
+    needed = fraction * histogram["count"]
+    seen = 0
+    for bound, count in zip(buckets, histogram["buckets"]):
+        seen += count
+        if seen >= needed:
+            return min(bound, histogram["max"])
+    return histogram["max"]
+
+def report(snapshot):
+    """Lines describing a snapshot, for people to read."""
+    lines = ["pid %d, up %s, as of %s" % 
+             (snapshot["pid"], 
+              int(snapshot["time"] - snapshot["started"]),
+              time.ctime(snapshot["time"]))]
+    for kind in ["counters", "gauges"]:
+        for name in sorted(snapshot[kind]):
+            for label, value in sorted(snapshot[kind][name].items()):
+                lines.append("%-24s %-20s %s" % (name, label, value))
+    for name in sorted(snapshot["histograms"]):
+        for label, histogram in sorted(snapshot["histograms"][name].items()):
+            lines.append("%-24s %-20s count %d mean %.3fs p50 %.3fs "
+                         "p95 %.3fs max %.3fs" % 
+                         (name, label, histogram["count"], 
+                          histogram["sum"] / max(histogram["count"], 1),
+                          quantile(histogram, 0.5), 
+                          quantile(histogram, 0.95), histogram["max"]))
+    return lines
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    """Reads one command per connection and replies with the JSON of 
+    what it returns."""
+    timeout = 10
+
+    def handle(self):
+        words = self.rfile.readline().split()
+        if not words or words[0] not in self.server.commands:
+            reply = {"error": "unknown command %s" % " ".join(words)}
+        else:
+            try:
+                reply = self.server.commands[words[0]](*words[1:])
+            except Exception as err:
+                logging.exception("Command %s failed", " ".join(words))
+                reply = {"error": str(err)}
+        self.wfile.write(json.dumps(reply) + "\n")
+
+class CommandServer(SocketServer.ThreadingMixIn, 
+                    SocketServer.UnixStreamServer):
+    """Listens on a Unix socket, only usable by the same user, for 
+    commands, which are looked up in commands, a dictionary from their
+    names to functions.  Runs on a thread of its own."""
+    daemon_threads = True
+
+    def __init__(self, address, commands):
+        if os.path.exists(address):
+            # left by an earlier run
+            os.remove(address)
+        SocketServer.UnixStreamServer.__init__(self, address, CommandHandler)
+        os.chmod(address, 0600)
+        self.address = address
+        self.commands = commands
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+def send_command(address, command, timeout = 60):
+    """Sends a command to a CommandServer and returns its reply.  Raises
+    socket.error if nothing is listening."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(address)
+        conn.sendall(command + "\n")
+        reply = conn.makefile("r").readline()
+    finally:
+        conn.close()
+    if not reply:
+        raise socket.error("no reply to %s" % command)
+    return json.loads(reply)
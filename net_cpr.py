@@ -0,0 +1,336 @@
+#! /usr/bin/python
+# -*- coding: UTF-8
+
+###############################################################################
+# CannedPostResponder
+# by Charlie Pashayan                                                          
+# 2012                                                                         
+# net_cpr.py: The module that schedules CannedPostResponder's requests to
+# Reddit
+#                                                                              
+# Copyright (c) 2012 Charlie Pashayan                                          
+#                                                                              
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to     
+# deal in the Software without restriction, including without limitation the   
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or  
+# sell copies of the Software, and to permit persons to whom the Software is   
+# furnished to do so, subject to the following conditions:                     
+#                                                                              
+# The above copyright notice and this permission notice shall be included in   
+# all copies or substantial portions of the Software.                         
+#                                                                             
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+###############################################################################
+
+import sys
+import time
+import random
+import logging
+import os
+import threading
+import Queue
+import format_cpr
+
+# priority lanes for the token bucket; lower numbers are served first
+REPLY, FETCH, INBOX = 0, 1, 2
+lane_names = ["reply", "fetch", "inbox"]
+
+# how many items Reddit sends back per request for a listing
+page_size = 100
+
+class TokenBucket:
+    """A token bucket that every request to Reddit has to take a token from,
+    whichever thread makes it.  Tokens accrue at rate per second, up to 
+    burst of them.  When several callers are waiting, the one in the lowest
+    numbered lane goes first.  Keeps track of how long each lane has spent
+    waiting, and adds each wait to metrics if given."""
+    def __init__(self, rate, burst = 1, metrics = None):
+        self.rate = float(rate)
+        self.metrics = metrics
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.stamp = time.time()
+        self.cond = threading.Condition()
+        self.waiting = [0] * len(lane_names)
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zeroes the request counts and waiting times for every lane."""
+        self.requests = [0] * len(lane_names)
+        self.waited = [0.0] * len(lane_names)
+        self.longest = [0.0] * len(lane_names)
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, 
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, lane):
+        """Blocks until the caller may make a request in the given lane."""
+        start = time.time()
+        with self.cond:
+            self.waiting[lane] += 1
+            try:
+                while True:
+                    self.refill()
+                    if self.tokens >= 1 and not any(self.waiting[:lane]):
+                        self.tokens -= 1
+                        break
+                    # sleep until the next token is due, or until a caller
+                    # with higher priority has taken the one that's here
+                    self.cond.wait(max(1 - self.tokens, 0.01) / self.rate)
+            finally:
+                self.waiting[lane] -= 1
+                self.cond.notify_all()
+            waited = time.time() - start
+            self.requests[lane] += 1
+            self.waited[lane] += waited
+            self.longest[lane] = max(self.longest[lane], waited)
+        if self.metrics is not None:
+            self.metrics.observe("rate_wait_seconds", waited, 
+                                 lane_names[lane])
+
+    def metered(self, listing, lane):
+        """Iterates over a listing from Reddit, taking a token before each 
+        page of it is requested."""
+        listing = iter(listing)
+        count = 0
+        while True:
+            if count % page_size == 0:
+                self.take(lane)
+            try:
+                item = next(listing)
+            except StopIteration:
+                return
+            count += 1
+            yield item
+
+    def __str__(self):
+        return "; ".join(["%s: %d requests waited %.1fs (longest %.1fs)" % 
+                          (lane_names[lane], self.requests[lane], 
+                           self.waited[lane], self.longest[lane])
+                          for lane in range(len(lane_names)) 
+                          if self.requests[lane]])
+
+def backoff(attempt, base, cap):
+    """How long to wait before retry number attempt (counting from 0): a 
+    random time up to base * 2**attempt seconds, but never more than cap.
+    The randomness keeps clients that failed together from retrying 
+    together."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def retry(call, retriable, attempts, base, cap):
+    """Calls call() until it succeeds, it raises something retriable(err)
+    says isn't worth retrying, or it has failed attempts times, backing off
+    between tries.  call() is always tried at least once, whatever attempts
+    is.  Returns what call() returns; raises the last error."""
+    attempts = max(attempts, 1)
+    for attempt in range(attempts):
+        try:
+            return call()
+        except Exception as err:
+            if attempt + 1 >= attempts or not retriable(err):
+                raise
+            delay = backoff(attempt, base, cap)
+            logging.warning("Request failed (%s); retrying in %.1fs.", 
+                            str(err), delay)
+            time.sleep(delay)
+
+class CircuitBreaker:
+    """Keeps a subreddit that keeps failing from being tried every cycle.
+    After threshold failures in a row the breaker opens, and the subreddit
+    is left alone for cooldown seconds.  After that one attempt is let 
+    through; if it fails too the breaker opens again for twice as long, up
+    to max_cooldown.  Any success closes the breaker."""
+    def __init__(self, threshold, cooldown, max_cooldown):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+
+    def allow(self):
+        return time.time() >= self.open_until
+
+    def is_open(self):
+        return not self.allow()
+
+    def success(self):
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        self.open_until = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.time() + self.cooldown
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+
+    def __str__(self):
+        if self.is_open():
+            return "open for %ds after %d failures" % \
+                (self.open_until - time.time(), self.failures)
+        return "closed after %d failures" % (self.failures)
+
+class PollScheduler:
+    """Decides when each subreddit is next worth polling, based on how often
+    posts turn up in it.  The gap between posts is tracked as a moving 
+    average of the gaps between the created_utc times of the posts seen, 
+    and a subreddit is polled again after about one gap, though never 
+    sooner than shortest or later than longest seconds.  The schedule is 
+    kept in a file so that it survives restarts."""
+    def __init__(self, filename, shortest, longest, smoothing = 0.3):
+        self.filename = filename
+        self.shortest = shortest
+        self.longest = longest
+        self.smoothing = smoothing
+        if os.path.exists(filename):
+            self.subs = dict(format_cpr.load_dict(filename, "schedule"))
+        else:
+            self.subs = {}
+
+    def state(self, sub):
+        return self.subs.setdefault(sub, {'gap': None, 'last_created': None,
+                                          'next_poll': 0})
+
+    def next_poll(self, sub):
+        return self.state(sub)['next_poll']
+
+    def due(self, sub):
+        return time.time() >= self.next_poll(sub)
+
+    def observe(self, sub, times):
+        """Takes note of the created_utc times of the posts found by a poll
+        of sub, and schedules the next one."""
+        state = self.state(sub)
+        for created in sorted(times):
+            last = state['last_created']
+            if last is not None and created > last:
+                if state['gap'] is None:
+                    state['gap'] = created - last
+                else:
+                    state['gap'] = (self.smoothing * (created - last) + 
+                                    (1 - self.smoothing) * state['gap'])
+            state['last_created'] = max(last, created)
+        now = time.time()
+        if state['gap'] is None:
+            # nothing to go on yet; come back soon to find out
+            interval = self.shortest
+        else:
+            # a silence longer than the usual gap means things have quieted
+            interval = max(state['gap'], now - state['last_created'])
+        interval = min(max(interval, self.shortest), self.longest)
+        state['next_poll'] = now + interval
+
+    def postpone(self, sub, delay):
+        """Schedules the next poll of sub for delay seconds from now, 
+        regardless of its posting rate; used when a poll fails."""
+        self.state(sub)['next_poll'] = time.time() + delay
+
+    def save(self):
+        format_cpr.dump_dict(self.filename, "schedule", self.subs)
+
+class Cancelled(Exception):
+    """Raised in a fetch thread whose stream nobody is reading any more."""
+    pass
+
+class Stream:
+    """A bounded pipe carrying one job's items from a fetch thread to the
+    main thread.  Once window items are waiting, the fetch thread blocks
+    until the main thread catches up, so no more than that many are ever
+    held at once.  The main thread waits a second at a time, so signals 
+    still get handled, and gives up with Cancelled if stop() says to."""
+    end = object()
+
+    def __init__(self, window, stop = None):
+        self.queue = Queue.Queue(max(window, 1))
+        self.exc_info = None
+        self.cancelled = False
+        self.stop = stop
+
+    def put(self, item):
+        while not self.cancelled:
+            try:
+                self.queue.put(item, timeout = 1)
+                return
+            except Queue.Full:
+                pass
+        raise Cancelled
+
+    def close(self, exc_info = None):
+        """Marks the end of the stream, passing along the error that ended
+        it if there was one."""
+        self.exc_info = exc_info
+        try:
+            self.put(Stream.end)
+        except Cancelled:
+            pass
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        """Yields items as they arrive; if the fetch thread failed, raises
+        what it raised once the items it got are used up."""
+        while True:
+            try:
+                item = self.queue.get(timeout = 1)
+            except Queue.Empty:
+                if self.stop and self.stop():
+                    raise Cancelled
+                continue
+            if item is Stream.end:
+                if self.exc_info:
+                    raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+                return
+            yield item
+
+def fetch_concurrently(jobs, fetch, workers, window, stop = None):
+    """Runs fetch(job, put) for every job on a pool of worker threads, where
+    put() passes one item along to the caller.  Yields (job, Stream) pairs 
+    in the order the jobs were given, so the caller can start on the first
+    job while the rest are still being fetched.  If the caller stops early,
+    the remaining jobs are abandoned.  stop is handed to every Stream."""
+    jobs = list(jobs)
+    streams = [Stream(window, stop) for job in jobs]
+    todo = Queue.Queue()
+    for number in range(len(jobs)):
+        todo.put(number)
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            try:
+                number = todo.get_nowait()
+            except Queue.Empty:
+                return
+            stream = streams[number]
+            try:
+                fetch(jobs[number], stream.put)
+            except Cancelled:
+                continue
+            except Exception:
+                stream.close(sys.exc_info())
+            else:
+                stream.close()
+
+    for i in range(max(min(workers, len(jobs)), 1)):
+        thread = threading.Thread(target = work)
+        thread.daemon = True
+        thread.start()
+    try:
+        for job, stream in zip(jobs, streams):
+            yield job, stream
+    finally:
+        stop.set()
+        for stream in streams:
+            stream.cancel()
@@ -0,0 +1,387 @@
+#! /usr/bin/python
+# -*- coding: UTF-8
+
+###############################################################################
+# CannedPostResponder
+# by Charlie Pashayan                                                          
+# 2012                                                                         
+# state_cpr.py: The module that keeps CannedPostResponder's record of what it
+# has seen and responded to in an SQLite database, and the log that keeps it
+# from responding to anything twice
+#                                                                              
+# Copyright (c) 2012 Charlie Pashayan                                          
+#                                                                              
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to     
+# deal in the Software without restriction, including without limitation the   
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or  
+# sell copies of the Software, and to permit persons to whom the Software is   
+# furnished to do so, subject to the following conditions:                     
+#                                                                              
+# The above copyright notice and this permission notice shall be included in   
+# all copies or substantial portions of the Software.                         
+#                                                                             
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR 
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE 
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER 
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+###############################################################################
+
+import sqlite3
+import time
+import math
+import hashlib
+import struct
+import os
+
+schema = """
+CREATE TABLE IF NOT EXISTS latest (
+    subreddit TEXT PRIMARY KEY,
+    post TEXT NOT NULL,
+    created_utc REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS responses (
+    subreddit TEXT NOT NULL,
+    post TEXT NOT NULL,
+    response TEXT,
+    responded_utc REAL NOT NULL,
+    PRIMARY KEY (subreddit, post)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class StateDB:
+    """The most recent post seen in each subreddit and the history of 
+    responses, stored in an SQLite database.  The database runs in WAL mode
+    so that cpr_admin.py can change it while CannedPostResponder is running.
+    Nothing is permanent until commit() is called, so callers decide how
+    many changes go into each transaction."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout = 30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(schema)
+        self.db.commit()
+
+    def latest(self, subreddit):
+        """Returns the (post, created_utc) of the most recent post seen in
+        subreddit, or None."""
+        row = self.db.execute("SELECT post, created_utc FROM latest "
+                              "WHERE subreddit = ?", (subreddit,)).fetchone()
+        return tuple(row) if row else None
+
+    def all_latest(self):
+        """Returns every subreddit's (post, created_utc) as a dictionary."""
+        rows = self.db.execute("SELECT subreddit, post, created_utc "
+                               "FROM latest")
+        return dict((row[0], (row[1], row[2])) for row in rows)
+
+    def set_latest(self, subreddit, post, created_utc):
+        self.db.execute("INSERT OR REPLACE INTO latest "
+                        "(subreddit, post, created_utc) VALUES (?, ?, ?)",
+                        (subreddit, post, created_utc))
+
+    def clear_latest(self, subreddits = None):
+        """Forgets the latest posts for the given subreddits, or for all of
+        them if none are given.  Commits immediately."""
+        if subreddits is None:
+            self.db.execute("DELETE FROM latest")
+        else:
+            self.db.executemany("DELETE FROM latest WHERE subreddit = ?",
+                                [(sub,) for sub in subreddits])
+        self.db.commit()
+
+    def has_response(self, subreddit, post):
+        row = self.db.execute("SELECT 1 FROM responses "
+                              "WHERE subreddit = ? AND post = ?",
+                              (subreddit, post)).fetchone()
+        return row is not None
+
+    def add_response(self, subreddit, post, response = None):
+        self.db.execute("INSERT OR IGNORE INTO responses "
+                        "(subreddit, post, response, responded_utc) "
+                        "VALUES (?, ?, ?, ?)",
+                        (subreddit, post, response, time.time()))
+
+    def all_responses(self):
+        """Iterates over the (subreddit, post) of every response."""
+        return self.db.execute("SELECT subreddit, post FROM responses")
+
+    def fingerprint(self):
+        """A cheap summary of the responses table, used to tell whether a 
+        saved filter still describes it."""
+        row = self.db.execute("SELECT COUNT(*), MAX(rowid) "
+                              "FROM responses").fetchone()
+        return "%d:%d" % (row[0], row[1] or 0)
+
+    def count_responses(self):
+        return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def response_subreddits(self):
+        return [row[0] for row in 
+                self.db.execute("SELECT DISTINCT subreddit FROM responses")]
+
+    def response_times(self, subreddit):
+        """Returns a dictionary giving the time each response in subreddit
+        was recorded.  Responses imported from the text files, which don't 
+        say when they were recorded, are dated now."""
+        self.db.execute("UPDATE responses SET responded_utc = ? "
+                        "WHERE subreddit = ? AND responded_utc = 0",
+                        (time.time(), subreddit))
+        return dict(self.db.execute("SELECT post, responded_utc "
+                                    "FROM responses WHERE subreddit = ?",
+                                    (subreddit,)))
+
+    def forget_responses(self, subreddit, posts = None):
+        """Deletes the responses to the given posts in subreddit, or all 
+        of them, returning how many were deleted."""
+        if posts is None:
+            return self.db.execute("DELETE FROM responses "
+                                   "WHERE subreddit = ?", 
+                                   (subreddit,)).rowcount
+        if not posts:
+            # executemany() reports a rowcount of -1 for no rows
+            return 0
+        before = self.db.total_changes
+        self.db.executemany("DELETE FROM responses "
+                            "WHERE subreddit = ? AND post = ?",
+                            [(subreddit, post) for post in posts])
+        return self.db.total_changes - before
+
+    def vacuum(self):
+        """Commits, then rebuilds the database file without the space left
+        by deleted rows and empties the write-ahead log into it."""
+        self.db.commit()
+        self.db.execute("VACUUM")
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def migrated(self):
+        """Says whether the old text files have already been imported."""
+        row = self.db.execute("SELECT value FROM meta "
+                              "WHERE key = 'migrated'").fetchone()
+        return row is not None
+
+    def migrate(self, latest, alreadies):
+        """Imports state from the old text files, given as the dictionaries
+        held by Latest and Alreadies, and marks the import as done so it
+        only ever happens once."""
+        for subreddit in latest:
+            post, created_utc = latest[subreddit]
+            self.set_latest(subreddit, post, created_utc)
+        for subreddit in alreadies:
+            self.db.executemany("INSERT OR IGNORE INTO responses "
+                                "(subreddit, post, responded_utc) "
+                                "VALUES (?, ?, 0)",
+                                [(subreddit, post_id) for 
+                                 post_id in alreadies[subreddit]])
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+                        "VALUES ('migrated', ?)", (str(time.time()),))
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class BloomFilter:
+    """A Bloom filter over "<subreddit> <post id>" keys.  It can say for sure
+    that a post has never been responded to, so the database only has to be
+    asked about posts the filter thinks it may have seen.  A filter never 
+    forgets anything, which is what makes that safe; once it holds more than
+    capacity keys it should be rebuilt bigger rather than replaced."""
+    def __init__(self, capacity, error_rate, bits = None, count = 0):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.nbits = int(math.ceil(-self.capacity * math.log(error_rate) / 
+                                   math.log(2) ** 2))
+        self.nhashes = max(int(round(self.nbits * math.log(2) / 
+                                     self.capacity)), 1)
+        if bits is None:
+            bits = bytearray((self.nbits + 7) // 8)
+        self.bits = bits
+        self.count = count
+
+    def positions(self, key):
+        digest = hashlib.md5(key.encode("UTF-8")).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % self.nbits 
+                for i in range(self.nhashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count > self.capacity
+
+    def nbytes(self):
+        return len(self.bits)
+
+    def expected_error_rate(self):
+        """The false positive rate to expect with the keys added so far."""
+        return (1 - math.exp(-float(self.nhashes) * self.count / 
+                             self.nbits)) ** self.nhashes
+
+    def __str__(self):
+        return ("%d of %d keys in %d bytes, false positive rate %.5f" % 
+                (self.count, self.capacity, self.nbytes(), 
+                 self.expected_error_rate()))
+
+    def save(self, filename, fingerprint):
+        """Writes the filter out along with the fingerprint of the 
+        database it describes, replacing the old file only once the new
+        one is complete."""
+        temp = filename + ".tmp"
+        fp = open(temp, "wb")
+        fp.write("%d %r %d %s\n" % (self.capacity, self.error_rate, 
+                                    self.count, fingerprint))
+        fp.write(self.bits)
+        fp.close()
+        os.rename(temp, filename)
+
+class RetentionPolicy:
+    """Decides which of the responses recorded in each subreddit are no 
+    longer worth remembering: those recorded more than days days ago, and 
+    all but the count most recent.  Either window can be 0, meaning no 
+    limit; with both at 0 nothing is forgotten.  The floor most recent 
+    responses in a subreddit are always kept, since Reddit may still show
+    those posts.  Once either window is set, everything recorded for a 
+    subreddit that isn't in subreddits is forgotten too."""
+    def __init__(self, days, count, subreddits, floor = 0):
+        self.days = days
+        self.count = count
+        self.subreddits = set(subreddit.lower() for subreddit in subreddits)
+        self.floor = floor
+
+    def enabled(self):
+        return bool(self.days or self.count)
+
+    def keeps(self, subreddit):
+        """Says whether anything recorded for subreddit should be kept."""
+        return not self.enabled() or subreddit.lower() in self.subreddits
+
+    def expired(self, posts):
+        """Returns the posts to forget, out of a dictionary giving the time
+        the response to each was recorded."""
+        if not self.enabled():
+            return []
+        # newest first; post ids count up, so they settle ties
+        ranked = sorted(posts, key = lambda post: (posts[post], 
+                                                   post_number(post)),
+                        reverse = True)
+        keep = len(ranked)
+        if self.count:
+            keep = min(keep, max(self.count, self.floor))
+        expired = ranked[keep:]
+        if self.days:
+            cutoff = time.time() - self.days * 86400
+            expired.extend(post for post in ranked[self.floor:keep] 
+                           if posts[post] < cutoff)
+        return expired
+
+def post_number(post):
+    """The number a Reddit post id stands for in base 36, or 0 if it isn't
+    one."""
+    try:
+        return int(post, 36)
+    except ValueError:
+        return 0
+
+class ResponseLog:
+    """A write-ahead log of the responses CannedPostResponder is about to 
+    post.  Each one is written out and synced to disk before it's posted,
+    and marked as failed if posting it fails, so anything in the log that
+    isn't marked failed may well have been posted.  After a crash those
+    are recorded as responded to before anything else is done.  The log is
+    emptied whenever the record it protects has been saved."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = None
+
+    def pending(self):
+        """The (subreddit, post) pairs in the log that weren't marked as
+        failed, in the order they were written."""
+        if not os.path.exists(self.filename):
+            return []
+        pending = []
+        for line in open(self.filename, "r"):
+            pieces = line.split()
+            if len(pieces) == 2 and tuple(pieces) not in pending:
+                pending.append(tuple(pieces))
+            elif len(pieces) == 3 and pieces[2] == "failed" and \
+                    tuple(pieces[:2]) in pending:
+                pending.remove(tuple(pieces[:2]))
+            # anything else is a partial line left by a crash
+        return pending
+
+    def write(self, line):
+        if not self.fp:
+            self.fp = open(self.filename, "a")
+        self.fp.write(line)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def intend(self, subreddit, post):
+        """Records that a response to post is about to be posted."""
+        self.write("%s %s\n" % (subreddit, post))
+
+    def failed(self, subreddit, post):
+        """Records that the response to post couldn't be posted."""
+        self.write("%s %s failed\n" % (subreddit, post))
+
+    def clear(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+def bloom_key(subreddit, post):
+    return u"%s %s" % (subreddit, post)
+
+def load_bloom(filename, db, capacity, error_rate):
+    """Returns a filter for the responses in db, read from filename if the
+    saved copy is up to date and built from the database otherwise."""
+    if os.path.exists(filename):
+        fp = open(filename, "rb")
+        header = fp.readline().split()
+        bits = bytearray(fp.read())
+        fp.close()
+        if len(header) == 4 and header[3] == db.fingerprint() and \
+                float(header[1]) == error_rate and \
+                int(header[0]) >= capacity:
+            bloom = BloomFilter(int(header[0]), error_rate, bits, 
+                                int(header[2]))
+            if len(bits) == bloom.nbytes():
+                return bloom
+    return build_bloom(db, capacity, error_rate)
+
+def build_bloom(db, capacity, error_rate):
+    """Builds a filter holding every response in db, with room for at
+    least capacity keys and twice as many as it holds now."""
+    capacity = max(capacity, 2 * db.count_responses())
+    bloom = BloomFilter(capacity, error_rate)
+    for subreddit, post in db.all_responses():
+        bloom.add(bloom_key(subreddit, post))
+    return bloom